@@ -1,8 +1,11 @@
 import app.api.routers
 import logging
-from fastapi.responses import JSONResponse
-from fastapi import APIRouter, Body, Depends, HTTPException, Query
+import json
+import contextlib
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError
 
 from app.schemas.exercise import ExerciseRequest, ExerciseResponse
 
@@ -11,84 +14,203 @@ from fastapi import Query
 from typing import Any, Dict, Literal
 import app.core.rag as rag
 import app.core.prompts as prompt  
-from app.services.exercise_service import _generate_exercise
+from app.core.retrieval import request_filters
+from app.core.backend_router import backend_router
+from app.core.config import settings
+from app.services.exercise_service import _generate_exercise, ainvoke_llm, stream_exercises
+import app.services.exercise_pool as exercise_pool
+from app.services.exercise_store import persist_batch
+import app.services.admission as admission
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 def _get_llm_pipeline(model_type: str):
-    """Get LLM pipeline with fallback logic"""
-    # Priority order: deepseek -> vertex -> ollama
-    if model_type == "deepseek" and rag.pipelines["deepseek"]["llm"]:
-        return "deepseek"
-    elif model_type == "vertex" and rag.pipelines["vertex"]["llm"]:
-        return "vertex"
-    elif model_type == "ollama" and rag.pipelines["ollama"]["llm"]:
-        return "ollama"
-    else:
-        # Fallback logic
-        for key in ["deepseek", "vertex", "ollama"]:
-            if rag.pipelines[key]["llm"]:
-                logger.info(f"Falling back to {key} LLM")
-                return key
+    """Backend for the request, chosen by the backend router (policy, latency, circuit state)"""
+    key = backend_router.choose(model_type)
+    if key is None:
         raise HTTPException(status_code=503, detail="No LLM pipeline available")
+    return key
+
+async def _serve_from_pool(body: Dict[str, Any], db: AsyncSession | None):
+    """Pooled exercises for a `"use_pool": true` request, or None on a miss."""
+    if not body.get("use_pool") or db is None:
+        return None
+    try:
+        return await exercise_pool.take(db, body, int(body.get("number", 1)))
+    except SQLAlchemyError as e:
+        logger.warning("Exercise pool unavailable, generating live: %s", e)
+        return None
+
+def _persist_after_response(background_tasks: BackgroundTasks, result: Dict[str, Any], body: Dict[str, Any]):
+    """Queue one bulk insert of the batch once the response has been sent."""
+    async def persist():
+        meta = {f: body.get(f) for f in ("name", "skill", "level", "type", "topic")}
+        meta.update(
+            generated_by=result.get("used_model"),
+            exercise_backends=result.get("exercise_backends"),
+            duration_seconds=result.get("duration_seconds", 0),
+            context_length=result.get("context_length", 0),
+        )
+        await persist_batch(result, meta)
+
+    background_tasks.add_task(persist)
+
+def _check_required(body: Dict[str, Any]):
+    required_fields = ["prompt_name", "number", "type", "skill", "level", "topic"]
+    missing = [f for f in required_fields if not body.get(f)]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing fields: {missing}")
+
+async def _prompt_renderer(body: Dict[str, Any], db: AsyncSession, context: str = ""):
+    """`render(n)`: the request's prompt for `n` exercises (used for fan-out sub-batches)."""
+    tpl = await prompt.get_prompt_template(body.get("prompt_name", "english_exercise_default"), db)
+    return lambda n: tpl.format(**{**body, "number": n}, context=context)
+
+async def _render_prompt(body: Dict[str, Any], db: AsyncSession, context: str = "", render=None) -> str:
+    render = render or await _prompt_renderer(body, db, context)
+    try:
+        return render(body.get("number", 1))
+    except Exception as e:
+        logger.error("Error formatting prompt %s with vars %s: %s", body.get("prompt_name"), body, e, exc_info=True)
+        raise HTTPException(status_code=400, detail=f"Prompt format error: {e}")
+
+def _context_mode(body: Dict[str, Any]) -> str:
+    # context_mode: "retriever" (default) formats the top-k documents directly;
+    # "llm" keeps the old RetrievalQA summarize step (one extra LLM call).
+    context_mode = body.get("context_mode", "retriever")
+    if context_mode not in ("retriever", "llm"):
+        raise HTTPException(status_code=400, detail=f"Invalid context_mode: {context_mode}")
+    return context_mode
+
+async def _rag_context(body: Dict[str, Any], key: str, context_mode: str):
+    """Retrieve context for the request; returns (context, source_docs, filters)."""
+    pipeline = rag.pipelines[key]
+    if not (pipeline.get("llm") and pipeline.get("chain")):
+        raise HTTPException(status_code=503, detail=f"RAG pipeline '{key}' chưa khởi tạo")
+
+    # Build RAG query
+    rag_query = (
+        f"Generate an English learning exercise for "
+        f"skill={body.get('skill')}, level={body.get('level')}, "
+        f"topic={body.get('topic')}, type={body.get('type')}"
+    )
+    # Pre-filter on level range / skill so e.g. A1 requests never get C1 context
+    filters = request_filters(body)
+    if context_mode == "llm":
+        await rag.refresh_index()
+        rag_out = await ainvoke_llm(rag.build_chain(key, filters), {"query": rag_query}, key)
+        return rag_out.get("result", ""), rag_out.get("source_documents", []), filters
+    try:
+        context, source_docs = await rag.retrieve_context(rag_query, filters)
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return context, source_docs, filters
+
+def _stream_response(
+    background_tasks: BackgroundTasks,
+    body: Dict[str, Any],
+    key: str,
+    prompt_text: str,
+    fmt: str,
+    **info: Any,
+) -> StreamingResponse:
+    """
+    Stream generation events as NDJSON lines or SSE messages. The first
+    event ("start") carries `used_model` and `info`; valid exercises are
+    collected and persisted once the stream ends, unless it ended short.
+    """
+    result: Dict[str, Any] = {"exercises": [], "used_model": key, **info}
+
+    number = int(body.get("number", 1))
+    tokens = admission.estimate_tokens(prompt_text, number)
+    try:
+        admission.check(key, tokens)  # reject with 429/503 before the stream starts
+    except HTTPException:
+        backend_router.release(key)
+        raise
+
+    async def events():
+        yield {"event": "start", "used_model": key, **info}
+        try:
+            async with contextlib.aclosing(stream_exercises(
+                rag.pipelines[key]["llm"], prompt_text, number, body.get("type"), backend=key,
+            )) as stream:
+                async for event in stream:
+                    if event["event"] == "exercise":
+                        result["exercises"].append(event["exercise"])
+                    elif event["event"] == "done":
+                        result["duration_seconds"] = event["duration_seconds"]
+                    yield event
+        except HTTPException as e:
+            yield {
+                "event": "error",
+                "status": e.status_code,
+                "detail": e.detail,
+                "retry_after": (e.headers or {}).get("Retry-After"),
+            }
+        finally:
+            backend_router.release(key)
+            # a short stream is kept out of the store, like a short batch
+            if len(result["exercises"]) < number:
+                result["validation_warnings"] = [
+                    f"Only {len(result['exercises'])} of {number} exercises met quality standards"
+                ]
+
+    async def encode():
+        # closing each level explicitly releases the LLM call as soon as the client goes away
+        async with contextlib.aclosing(events()) as stream:
+            async for event in stream:
+                data = json.dumps(event, ensure_ascii=False)
+                yield f"event: {event['event']}\ndata: {data}\n\n" if fmt == "sse" else data + "\n"
+
+    _persist_after_response(background_tasks, result, body)
+    media_type = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return StreamingResponse(encode(), media_type=media_type)
 
 @router.post("/no-rag")
 async def generate_no_rag(
+    background_tasks: BackgroundTasks,
     body: Dict[str, Any] = Body(...),
     model_type: Literal["ollama", "vertex", "deepseek"] = Query("ollama", alias="modelType"),
     db: AsyncSession = Depends(get_db),
 ):
 
-    required_fields = ["prompt_name", "number", "type", "skill", "level", "topic"]
-    missing = [f for f in required_fields if not body.get(f)]
-    if missing:
-        raise HTTPException(status_code=400, detail=f"Missing fields: {missing}")
-    
-    prompt_name = body.get("prompt_name","english_exercise_default")
+    _check_required(body)
+
     number = body.get("number", 1)
     exercise_type = body.get("type", "mcq")
+    use_cache = not body.get("bypass_cache", False)
 
-    tpl = await prompt.get_prompt_template(prompt_name, db)
+    pooled = await _serve_from_pool(body, db)
+    if pooled is not None:
+        return JSONResponse(status_code=200, content=pooled)
 
-    try:
-        prompt_text = tpl.format(**body, context="") #body.get("context", "No context provided")
-    except Exception as e:
-        logger.error("Error formatting prompt %s with vars %s: %s", prompt_name, body, e, exc_info=True)
-        raise HTTPException(status_code=400, detail=f"Prompt format error: {e}")
+    render = await _prompt_renderer(body, db)
+    prompt_text = await _render_prompt(body, db, render=render)
 
-    # Get LLM with fallback
     key = _get_llm_pipeline(model_type)
     llm = rag.pipelines[key]["llm"]
-    
     logger.info(f"Using {key} LLM for generation")
-
-    # Generate exercise with memory error handling
     try:
-        result = await _generate_exercise(llm, prompt_text, expected_count=number, expected_type=exercise_type)
-    except MemoryError:
-        logger.warning(f"MemoryError on {key}, trying fallback")
-        # Try other available pipelines
-        for fallback_key in ["deepseek", "vertex", "ollama"]:
-            if fallback_key != key and rag.pipelines[fallback_key]["llm"]:
-                logger.info(f"Retrying with {fallback_key}")
-                llm = rag.pipelines[fallback_key]["llm"]
-                try:
-                    result = await _generate_exercise(llm, prompt_text, expected_count=number, expected_type=exercise_type)
-                    break
-                except MemoryError:
-                    continue
-        else:
-            raise HTTPException(status_code=503, detail="All LLM pipelines failed due to memory issues")
+        result = await _generate_exercise(
+            llm, prompt_text, expected_count=number, expected_type=exercise_type, backend=key,
+            use_cache=use_cache, request=body, scope="no-rag", render=render,
+            hedge=body.get("hedge", settings.hedging_enabled),
+        )
+    finally:
+        backend_router.release(key)
 
     result["context_length"] = 0
-    result["used_model"] = key
+    result["used_model"] = result.get("hedge", {}).get("backend") or key
+    _persist_after_response(background_tasks, result, body)
     return JSONResponse(status_code=200, content=result)
 
 
 @router.post("/native-rag")
 async def generate_native_rag(
+    background_tasks: BackgroundTasks,
     body: Dict[str, Any] = Body(...),
     model_type: Literal["ollama", "vertex", "deepseek"] = Query("ollama", alias="modelType"),
     db: AsyncSession = Depends(get_db),
@@ -98,39 +220,77 @@ async def generate_native_rag(
     Body cần có: prompt_name, skill, level, topic, type, …
     """
 
-    required_fields = ["prompt_name", "number", "type", "skill", "level", "topic"]
-    missing = [f for f in required_fields if not body.get(f)]
-    if missing:
-        raise HTTPException(status_code=400, detail=f"Missing fields: {missing}")
-    
-    # Get RAG context first
-    key = _get_llm_pipeline(model_type)
-    pipeline = rag.pipelines[key]
-    llm, chain = pipeline.get("llm"), pipeline.get("chain")
-    if not (llm and chain):
-        raise HTTPException(status_code=503, detail=f"RAG pipeline '{key}' chưa khởi tạo")
+    _check_required(body)
+    context_mode = _context_mode(body)
 
-    # Build RAG query
-    rag_query = (
-        f"Generate an English learning exercise for "
-        f"skill={body.get('skill')}, level={body.get('level')}, "
-        f"topic={body.get('topic')}, type={body.get('type')}"
-    )
-    rag_out = chain({"query": rag_query})
-    context = rag_out.get("result", "")
+    pooled = await _serve_from_pool(body, db)
+    if pooled is not None:
+        return JSONResponse(status_code=200, content=pooled)
 
-    # 3) Get and format template
-    prompt_name = body.get("prompt_name", "english_exercise_default")
-    number = body.get("number", 1)
-    tpl = await prompt.get_prompt_template(prompt_name, db)
+    key = _get_llm_pipeline(model_type)
+    llm = rag.pipelines[key]["llm"]
     try:
-        prompt_text = tpl.format(**body, context=context)
-    except Exception as e:
-        logger.error("Error formatting prompt %s: %s", prompt_name, e, exc_info=True)
-        raise HTTPException(status_code=400, detail=f"Prompt format error: {e}")
+        context, source_docs, filters = await _rag_context(body, key, context_mode)
+
+        # 3) Get and format template
+        number = body.get("number", 1)
+        render = await _prompt_renderer(body, db, context)
+        prompt_text = await _render_prompt(body, db, render=render)
 
-    # 4) Gọi LLM
-    result = await _generate_exercise(llm, prompt_text, number, body.get("type"))
+        # 4) Gọi LLM
+        result = await _generate_exercise(
+            llm, prompt_text, number, body.get("type"), backend=key,
+            use_cache=not body.get("bypass_cache", False), request=body, scope="native-rag", render=render,
+            hedge=body.get("hedge", settings.hedging_enabled),
+        )
+    finally:
+        backend_router.release(key)
     result["context_length"] = len(context)
-    result["used_model"] = key
-    return JSONResponse(status_code=200, content=result)
\ No newline at end of file
+    result["context_mode"] = context_mode
+    result["context_filters"] = filters
+    result["context_sources"] = [d.metadata.get("id") for d in source_docs]
+    result["used_model"] = result.get("hedge", {}).get("backend") or key
+    _persist_after_response(background_tasks, result, body)
+    return JSONResponse(status_code=200, content=result)
+
+
+@router.post("/no-rag/stream")
+async def stream_no_rag(
+    background_tasks: BackgroundTasks,
+    body: Dict[str, Any] = Body(...),
+    model_type: Literal["ollama", "vertex", "deepseek"] = Query("ollama", alias="modelType"),
+    fmt: Literal["ndjson", "sse"] = Query("ndjson", alias="format"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Like /no-rag, but streams each exercise as soon as it is generated and validated."""
+    _check_required(body)
+    prompt_text = await _render_prompt(body, db)
+    key = _get_llm_pipeline(model_type)
+    return _stream_response(background_tasks, body, key, prompt_text, fmt, context_length=0)
+
+
+@router.post("/native-rag/stream")
+async def stream_native_rag(
+    background_tasks: BackgroundTasks,
+    body: Dict[str, Any] = Body(...),
+    model_type: Literal["ollama", "vertex", "deepseek"] = Query("ollama", alias="modelType"),
+    fmt: Literal["ndjson", "sse"] = Query("ndjson", alias="format"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Like /native-rag, but streams each exercise as soon as it is generated and validated."""
+    _check_required(body)
+    context_mode = _context_mode(body)
+    key = _get_llm_pipeline(model_type)
+    try:
+        context, source_docs, filters = await _rag_context(body, key, context_mode)
+        prompt_text = await _render_prompt(body, db, context)
+    except Exception:
+        backend_router.release(key)
+        raise
+    return _stream_response(
+        background_tasks, body, key, prompt_text, fmt,
+        context_length=len(context),
+        context_mode=context_mode,
+        context_filters=filters,
+        context_sources=[d.metadata.get("id") for d in source_docs],
+    )
@@ -0,0 +1,179 @@
+import time
+import asyncio
+import logging
+import contextlib
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from app.core.config import settings
+import app.core.rag as rag
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("deepseek", "vertex", "ollama")
+
+
+class BackendState:
+    """Latency / error tracking and circuit breaker for one backend."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0  # EWMA of failures (0..1)
+        self.in_flight = 0
+        self.calls = self.failures = 0
+        self.consecutive_failures = 0
+        self.circuit = "closed"  # closed | open | half_open
+        self.opened_at = 0.0
+        self.trial_at: Optional[float] = None  # when the half-open trial call was reserved
+        self.latencies: deque = deque(maxlen=settings.backend_latency_window)
+
+    def record(self, seconds: float, ok: bool):
+        alpha = settings.backend_ewma_alpha
+        self.calls += 1
+        self.trial_at = None
+        if ok:
+            self.latencies.append(seconds)
+            self.latency_ewma = seconds if self.latency_ewma is None else (1 - alpha) * self.latency_ewma + alpha * seconds
+            self.error_rate = (1 - alpha) * self.error_rate
+            self.consecutive_failures = 0
+            if self.circuit != "closed":
+                logger.info("Circuit for %s closed", self.name)
+            self.circuit = "closed"
+            return
+
+        self.failures += 1
+        self.error_rate = (1 - alpha) * self.error_rate + alpha
+        self.consecutive_failures += 1
+        if self.circuit == "half_open" or self.consecutive_failures >= settings.circuit_failure_threshold:
+            if self.circuit != "open":
+                logger.warning("Circuit for %s opened after %d failures", self.name, self.consecutive_failures)
+            self.circuit = "open"
+            self.opened_at = time.monotonic()
+
+    def percentile(self, q: float, min_samples: int = 5) -> Optional[float]:
+        """Latency percentile over the recent successful calls, None while too few."""
+        if len(self.latencies) < min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def allows(self) -> bool:
+        """
+        Closed circuits take traffic; an open one, after the cooldown, takes
+        one trial call at a time (see reserve). No side effects.
+        """
+        if self.circuit == "closed":
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < settings.circuit_open_seconds:
+            return False
+        # a reservation whose call never reported back expires after another cooldown
+        return self.trial_at is None or now - self.trial_at >= settings.circuit_open_seconds
+
+    def reserve(self) -> bool:
+        """Claim the call about to be made; on a recovering circuit this is the single trial."""
+        if not self.allows():
+            return False
+        if self.circuit != "closed":
+            self.circuit = "half_open"
+            self.trial_at = time.monotonic()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "circuit": self.circuit,
+            "latency_ewma_seconds": round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            "latency_p95_seconds": round(p95, 3) if (p95 := self.percentile(0.95)) is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class BackendRouter:
+    """
+    Picks the LLM backend for a request from the initialised entries in
+    rag.pipelines, skipping backends whose circuit is open.
+
+    settings.backend_policy:
+      "pinned"   - the requested backend, then settings.backend_priority
+      "fastest"  - lowest EWMA latency, scaled up by in-flight calls
+                   (backends without samples are tried first)
+      "cheapest" - settings.backend_cost_order
+    """
+
+    def __init__(self):
+        self.backends = {name: BackendState(name) for name in BACKENDS}
+
+    def _available(self) -> List[str]:
+        return [k for k in BACKENDS if rag.pipelines.get(k, {}).get("llm") is not None]
+
+    def candidates(self, requested: Optional[str] = None) -> List[str]:
+        """Healthy, initialised backends in policy order."""
+        available = self._available()
+        policy = settings.backend_policy
+        if policy == "fastest":
+            def cost(k):
+                s = self.backends[k]
+                return -1.0 if s.latency_ewma is None else s.latency_ewma * (1 + s.in_flight)
+            order = sorted(available, key=cost)
+        elif policy == "cheapest":
+            ranked = settings.backend_cost_order
+            order = sorted(available, key=lambda k: ranked.index(k) if k in ranked else len(ranked))
+        else:
+            ranked = [requested] + [k for k in settings.backend_priority if k != requested]
+            order = sorted(available, key=lambda k: ranked.index(k) if k in ranked else len(ranked))
+        return [k for k in order if self.backends[k].allows()]
+
+    def choose(self, requested: Optional[str] = None) -> Optional[str]:
+        """The first candidate, reserving the trial call if its circuit is recovering."""
+        chosen = next((k for k in self.candidates(requested) if self.backends[k].reserve()), None)
+        if chosen is not None and chosen != requested:
+            logger.info("Routing to %s (requested %s, policy %s)", chosen, requested, settings.backend_policy)
+        return chosen
+
+    def release(self, backend: Optional[str]):
+        """
+        End of a request that chose `backend`: give back a half-open trial
+        reservation that no LLM call used (pool / cache hit, early error).
+        A call that did run has already settled it in record().
+        """
+        state = self.backends.get(backend) if backend else None
+        if state is not None and state.in_flight == 0:
+            state.trial_at = None
+
+    @contextlib.asynccontextmanager
+    async def track(self, backend: Optional[str]):
+        """Record latency and success/failure of one LLM call on `backend`."""
+        state = self.backends.get(backend) if backend else None
+        if state is None:
+            yield
+            return
+        state.in_flight += 1
+        start = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        except (asyncio.CancelledError, GeneratorExit):
+            # cancelled calls and streams closed early say nothing about the backend
+            ok = None
+            raise
+        finally:
+            state.in_flight -= 1
+            if ok is not None:
+                state.record(time.monotonic() - start, ok)
+            else:
+                state.trial_at = None  # release the trial reservation
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": settings.backend_policy,
+            "backends": {k: s.stats() for k, s in self.backends.items()},
+        }
+
+
+backend_router = BackendRouter()
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict, EnvSettingsSource
-from typing import Literal
+from typing import Dict, List, Literal
 
 class Settings(BaseSettings):
     mysql_user: str 
@@ -24,6 +24,87 @@ class Settings(BaseSettings):
     deepseek_base_url: str = "https://api.deepseek.com"
     
     hf_embedding_model: str = "sentence-transformers/all-mpnet-base-v2"
+    embed_batch_size: int = 256
+    chunk_codec: Literal["gzip", "zstd"] | None = None  # compression for data/chunks.jsonl
+
+    # Retrieval: BM25 + dense fusion; lexical-only when query embedding gets slow
+    retrieval_mode: Literal["hybrid", "dense", "lexical"] = "hybrid"
+    hybrid_alpha: float = 0.5  # weight of the dense ranking
+    lexical_fallback_ms: float | None = None
+    embedding_cache_size: int = 4096
+    retrieval_cache_size: int = 1024
+    retrieval_cache_ttl: float = 3600.0
+
+    # Exact-match cache for validated exercise generations
+    response_cache_enabled: bool = True
+    response_cache_size: int = 512
+    response_cache_ttl: float = 600.0
+
+    # Semantic cache: reuse batches for the same skill/level/type and a near-identical topic
+    semantic_cache_enabled: bool = True
+    semantic_cache_threshold: float = 0.92
+    semantic_cache_size: int = 256
+    semantic_cache_ttl: float = 3600.0
+    extract_workers: int | None = None  # None = one per CPU
+
+    # Store every freshly generated batch in the exercises table (background task)
+    persist_generations: bool = True
+
+    # Pre-generated exercise pool per (skill, level, type, topic) bucket
+    exercise_pool_enabled: bool = False
+    exercise_pool_buckets: List[Dict[str, str]] = []  # seeded; pool-mode requests add more
+    exercise_pool_max_requested_buckets: int = 50  # cap on request-added buckets (0 = configured only)
+    exercise_pool_bucket_ttl: float = 3600.0  # request-added buckets expire when not requested this long
+    exercise_pool_target: int = 20
+    exercise_pool_batch_size: int = 5
+    exercise_pool_interval: float = 60.0
+    exercise_pool_backend: Literal["ollama", "vertex", "deepseek"] = "ollama"
+    exercise_pool_prompt: str = "english_exercise_default"
+
+    # Split batches above fanout_batch_size into concurrent sub-batches (0 = off);
+    # fanout_across_backends spreads them over other backends (not with "pinned")
+    fanout_batch_size: int = 5
+    fanout_max_parallel: int = 3
+    fanout_across_backends: bool = False
+
+    # Backend routing: pinned (requested modelType, then backend_priority),
+    # fastest (EWMA latency) or cheapest (backend_cost_order)
+    backend_policy: Literal["pinned", "fastest", "cheapest"] = "pinned"
+    backend_priority: List[str] = ["deepseek", "vertex", "ollama"]
+    backend_cost_order: List[str] = ["ollama", "deepseek", "vertex"]
+    backend_ewma_alpha: float = 0.2
+    circuit_failure_threshold: int = 3  # consecutive failures before a backend is skipped
+    circuit_open_seconds: float = 30.0  # then one trial call is let through
+    backend_latency_window: int = 200  # recent calls kept for latency percentiles
+
+    # Hedging: if the primary backend has no valid result after its p95
+    # latency (x hedge_delay_factor), also ask the next backend; first valid wins
+    hedging_enabled: bool = False  # default for requests without "hedge"
+    hedge_delay_factor: float = 1.0
+    hedge_default_delay: float = 10.0  # seconds, until the backend has enough samples
+    hedge_min_delay: float = 1.0
+
+    # Max concurrent LLM generations per backend (requests beyond this wait)
+    ollama_max_concurrency: int = 1
+    deepseek_max_concurrency: int = 8
+    vertex_max_concurrency: int = 8
+
+    # Admission control per backend: token buckets (0 = unlimited), a cap on
+    # admitted-but-unfinished calls (0 = the backend's max_concurrency, so
+    # admitted calls never wait again on its semaphore), and a bounded wait
+    # queue. Requests that cannot be admitted get 429/503 with Retry-After.
+    ollama_requests_per_minute: float = 30
+    ollama_tokens_per_minute: float = 0
+    ollama_max_pending: int = 0
+    deepseek_requests_per_minute: float = 60
+    deepseek_tokens_per_minute: float = 0
+    deepseek_max_pending: int = 0
+    vertex_requests_per_minute: float = 60
+    vertex_tokens_per_minute: float = 0
+    vertex_max_pending: int = 0
+    admission_max_queue: int = 32
+    admission_max_queue_seconds: float = 10.0
+    est_tokens_per_exercise: int = 200  # completion estimate for the token buckets
     
     use_vertex: bool = True
     use_deepseek: bool = False
@@ -1,26 +1,36 @@
-import shutil
+import re
+import asyncio
+import threading
 import logging
 from pathlib import Path
+from typing import List
 from dotenv import load_dotenv
 
 from langchain_community.llms import Ollama
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from langchain_community.vectorstores import Chroma
 from langchain_google_vertexai import ChatVertexAI, VertexAIEmbeddings
 from langchain_openai import ChatOpenAI  # For DeepSeek API
 from langchain.chains import RetrievalQA
+from langchain_core.embeddings import Embeddings
 
 from google.oauth2 import service_account
 
 from app.core.config import settings
-from data_pipeline import collect_and_process, save_chunks, build_vector_store
+from data_pipeline import (
+    collect_and_process, save_chunks, load_or_build_vector_store, corpus_hash, iter_json_chunks,
+    open_level_partitions, read_index_manifest, InvertedIndex, LEXICAL_INDEX, INDEX_MANIFEST,
+)
+from app.core.retrieval import HybridRetriever
+from app.core.cache import TTLCache
+from chunk_store import ChunkStore, migrate_json_chunks, store_path
 import torch
 logger = logging.getLogger(__name__)
 
 DATA_DIR    = Path("data")
-CHUNKS_FILE = DATA_DIR / "chunks.json"
-OLLAMA_DB   = Path("./chroma_db/ollama")
-VERTEX_DB   = Path("./chroma_db/vertex")
-DEEPSEEK_DB = Path("./chroma_db/deepseek")
+CHUNKS_FILE = store_path(DATA_DIR / "chunks.jsonl", settings.chunk_codec)
+LEGACY_CHUNKS_FILE = DATA_DIR / "chunks.json"
+VECTOR_DB   = Path("./chroma_db")
 KEY_DIR     = Path("./key")
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -31,23 +41,246 @@ pipelines = {
     "deepseek": {"llm": None, "chain": None},
 }
 
+# Per-backend cap on concurrent generations; see settings.*_max_concurrency.
+semaphores = {
+    "ollama": asyncio.Semaphore(settings.ollama_max_concurrency),
+    "vertex": asyncio.Semaphore(settings.vertex_max_concurrency),
+    "deepseek": asyncio.Semaphore(settings.deepseek_max_concurrency),
+}
+
+# Shared across every entry in `pipelines`: one embedding model instance per
+# model name, one vector store per (embedding model, corpus version).
+_embeddings: dict[str, "CachedQueryEmbeddings"] = {}
+_vector_stores: dict[tuple[str, str], Chroma] = {}
+_partitions: dict[tuple[str, str], dict[str, Chroma]] = {}
+_lexical: dict[tuple[str, str], InvertedIndex] = {}
+retriever: HybridRetriever | None = None
+index_version: str | None = None
+# (persist dir, manifest mtime, corpus_hash) of the index the retriever serves
+_loaded_manifest: tuple[Path, int, str | None] | None = None
+_refresh_lock = threading.Lock()
+
+# Query strings are templated from a handful of request fields, so the same
+# queries recur constantly. Both caches are cleared whenever a new index
+# version is loaded (see get_vector_store) or the index manifest on disk
+# changes under the running app (see refresh_index).
+embedding_cache = TTLCache(settings.embedding_cache_size, name="query_embeddings")
+retrieval_cache = TTLCache(settings.retrieval_cache_size, ttl=settings.retrieval_cache_ttl, name="retrieval")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Memoizes embed_query; document embedding passes straight through."""
+
+    def __init__(self, inner: Embeddings, model_name: str):
+        self.inner = inner
+        self.model_name = model_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model_name, normalize_query(text))
+        vector = embedding_cache.get(key)
+        if vector is None:
+            vector = self.inner.embed_query(text)
+            embedding_cache.set(key, vector)
+        return vector
+
+
+def get_embedding(model_name: str | None = None) -> CachedQueryEmbeddings:
+    model_name = model_name or settings.hf_embedding_model
+    if model_name not in _embeddings:
+        _embeddings[model_name] = CachedQueryEmbeddings(
+            HuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': device}),
+            model_name,
+        )
+        logger.info(f"Loaded embedding model {model_name} on {device}")
+    return _embeddings[model_name]
+
+
+def _store_key(model_name: str) -> tuple[str, str]:
+    return (model_name, corpus_hash(CHUNKS_FILE)[:16])
+
+
+def _persist_dir(model_name: str) -> Path:
+    return VECTOR_DB / re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+
+
+def _manifest_state(persist_dir: Path) -> tuple[Path, int, str | None]:
+    try:
+        mtime = (persist_dir / INDEX_MANIFEST).stat().st_mtime_ns
+    except OSError:
+        mtime = 0
+    manifest = read_index_manifest(persist_dir) or {}
+    return persist_dir, mtime, manifest.get("corpus_hash")
+
+
+def _index_changed() -> bool:
+    """Cheap check (one stat) whether the manifest was rewritten since it was loaded."""
+    if _loaded_manifest is None:
+        return False
+    persist_dir, mtime, _ = _loaded_manifest
+    try:
+        return (persist_dir / INDEX_MANIFEST).stat().st_mtime_ns != mtime
+    except OSError:
+        return mtime != 0
+
+
+def _refresh_index():
+    """
+    Pick up a rebuild / sync of the index made outside the app (e.g. the
+    data_pipeline CLI): when the manifest's corpus_hash changed, reopen the
+    vector store, level partitions, lexical index and chunk store together
+    and drop the embedding and retrieval caches. Blocking; see refresh_index.
+    """
+    global _loaded_manifest, retriever
+    with _refresh_lock:
+        persist_dir, _, loaded_hash = _loaded_manifest
+        state = _manifest_state(persist_dir)
+        if state[2] == loaded_hash:
+            _loaded_manifest = state
+            return
+        logger.info("Index manifest changed on disk, reopening the index and clearing RAG caches")
+        model_name = settings.hf_embedding_model
+        for key in [k for k in _vector_stores if k[0] == model_name]:
+            for handles in (_vector_stores, _partitions, _lexical):
+                handles.pop(key, None)
+        retriever = get_retriever(retriever.k if retriever is not None else 3)
+        for key, pipeline in pipelines.items():
+            if pipeline.get("llm") is not None:
+                _register_pipeline(key, pipeline["llm"], retriever)
+        _loaded_manifest = state
+
+
+async def refresh_index():
+    """Cheap per-request check; the reload itself runs off the event loop."""
+    if _index_changed():
+        await asyncio.to_thread(_refresh_index)
+
+
+def get_vector_store(model_name: str | None = None) -> Chroma:
+    """Return the shared vector store for the current corpus, building it once."""
+    global index_version, _loaded_manifest
+    model_name = model_name or settings.hf_embedding_model
+    key = _store_key(model_name)
+    if key not in _vector_stores:
+        embedding_cache.clear()
+        retrieval_cache.clear()
+        index_version = ":".join(key)
+        persist_dir = _persist_dir(model_name)
+        _vector_stores[key] = load_or_build_vector_store(
+            CHUNKS_FILE, persist_dir,
+            embedding=get_embedding(model_name),
+            embedding_model=model_name,
+            batch_size=settings.embed_batch_size,
+        )
+        _partitions[key] = open_level_partitions(persist_dir, get_embedding(model_name))
+        _lexical[key] = InvertedIndex.load(persist_dir / LEXICAL_INDEX)
+        if model_name == settings.hf_embedding_model:
+            _loaded_manifest = _manifest_state(persist_dir)
+    return _vector_stores[key]
+
+
+def get_retriever(k: int = 3) -> HybridRetriever:
+    store = get_vector_store()
+    key = _store_key(settings.hf_embedding_model)
+    return HybridRetriever(
+        store=store,
+        partitions=_partitions[key],
+        lexical=_lexical[key],
+        chunks=ChunkStore(CHUNKS_FILE),
+        k=k,
+        mode=settings.retrieval_mode,
+        alpha=settings.hybrid_alpha,
+        max_embed_ms=settings.lexical_fallback_ms,
+    )
+
+
+def build_chain(key: str, filters: dict | None = None):
+    """RetrievalQA chain for `key` whose retriever applies request filters."""
+    return RetrievalQA.from_chain_type(
+        llm=pipelines[key]["llm"],
+        chain_type="stuff",
+        retriever=retriever.with_filters(filters or {}),
+        return_source_documents=True,
+    )
+
+
+def format_context(docs) -> str:
+    """Render retrieved documents as numbered, source-tagged context blocks."""
+    blocks = []
+    for i, doc in enumerate(docs, start=1):
+        meta = doc.metadata or {}
+        header = (
+            f"[{i}] id={meta.get('id')} source={meta.get('source')} "
+            f"type={meta.get('type')} level={meta.get('level')} name={meta.get('name')}"
+        )
+        blocks.append(f"{header}\n{doc.page_content.strip()}")
+    return "\n\n".join(blocks)
+
+
+async def retrieve_context(query: str, filters: dict | None = None):
+    """Retriever-only context: top-k documents formatted without an LLM call."""
+    if retriever is None:
+        raise RuntimeError("Vector store retriever is not initialized")
+    await refresh_index()
+    key = (
+        index_version,
+        normalize_query(query),
+        tuple(sorted((k, str(v)) for k, v in (filters or {}).items())),
+        retriever.mode,
+        retriever.k,
+    )
+    docs = retrieval_cache.get(key)
+    if docs is None:
+        scoped = retriever.with_filters(filters) if filters else retriever
+        # embedding + search are CPU-bound, keep them off the event loop
+        docs = await asyncio.to_thread(scoped.get_relevant_documents, query)
+        retrieval_cache.set(key, docs)
+    return format_context(docs), docs
+
+
+def cache_stats() -> dict:
+    return {
+        "index_version": index_version,
+        "query_embeddings": embedding_cache.stats(),
+        "retrieval": retrieval_cache.stats(),
+    }
+
+
+def _register_pipeline(key: str, llm, retriever):
+    """Attach an LLM client to the shared retriever. No per-backend index."""
+    pipelines[key]["llm"] = llm
+    pipelines[key]["chain"] = RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=retriever,
+        return_source_documents=True,
+    ) if retriever is not None else None
+
 
 def initialize_components():
+    global retriever
     print("Initializing LLM & Embedding…")
     DATA_DIR.mkdir(exist_ok=True)
 
-    # ------------ clean out stores ------------
-    for db in (OLLAMA_DB, VERTEX_DB, DEEPSEEK_DB):
-        if db.exists():
-            shutil.rmtree(db)
-            logger.info(f"Removed old vector store at {db}")
-
     # ------------ prepare chunks ------------
+    migrate_json_chunks(LEGACY_CHUNKS_FILE, ChunkStore(CHUNKS_FILE), iter_json_chunks)
     if not CHUNKS_FILE.exists():
-        chunks = collect_and_process()
+        chunks = collect_and_process(workers=settings.extract_workers)
         save_chunks(chunks, CHUNKS_FILE)
 
-    # ------------ 1) Ollama + HF embeddings ------------
+    # ------------ shared embeddings + index ------------
+    try:
+        retriever = get_retriever()
+    except Exception as e:
+        logger.error("Failed to initialize shared vector store: %s", e, exc_info=True)
+
+    # ------------ 1) Ollama ------------
     try:
         # Use configurable Ollama settings with timeout and host
         llm_ollama = Ollama(
@@ -55,16 +288,7 @@ def initialize_components():
             base_url=settings.ollama_host,
             timeout=settings.ollama_timeout
         )
-        embed_hf = HuggingFaceEmbeddings(model_name=settings.hf_embedding_model)
-        vs_ollama = build_vector_store(CHUNKS_FILE, OLLAMA_DB, embedding=embed_hf)
-        retr_ollama = vs_ollama.as_retriever(search_kwargs={"k": 3})
-        pipelines["ollama"]["llm"] = llm_ollama
-        pipelines["ollama"]["chain"] = RetrievalQA.from_chain_type(
-            llm=llm_ollama,
-            chain_type="stuff",
-            retriever=retr_ollama,
-            return_source_documents=True,
-        )
+        _register_pipeline("ollama", llm_ollama, retriever)
         logger.info(f"Ollama pipeline initialized with model: {settings.ollama_model}")
     except Exception as e:
         logger.error("Failed to initialize Ollama pipeline: %s", e, exc_info=True)
@@ -80,19 +304,7 @@ def initialize_components():
                 temperature=0.7,
                 max_tokens=2048,
             )
-            embed_hf_deepseek = HuggingFaceEmbeddings(
-                model_name=settings.hf_embedding_model,
-                model_kwargs={'device': device}
-            )
-            vs_deepseek = build_vector_store(CHUNKS_FILE, DEEPSEEK_DB, embedding=embed_hf_deepseek)
-            retr_deepseek = vs_deepseek.as_retriever(search_kwargs={"k": 3})
-            pipelines["deepseek"]["llm"] = llm_deepseek
-            pipelines["deepseek"]["chain"] = RetrievalQA.from_chain_type(
-                llm=llm_deepseek,
-                chain_type="stuff",
-                retriever=retr_deepseek,
-                return_source_documents=True,
-            )
+            _register_pipeline("deepseek", llm_deepseek, retriever)
             logger.info(f"DeepSeek pipeline initialized with model: {settings.deepseek_model}")
         except Exception as e:
             logger.error("Failed to initialize DeepSeek pipeline: %s", e, exc_info=True)
@@ -119,8 +331,7 @@ def initialize_components():
             #     min_batch_size=5,        # back off down to 5 if needed
             # )
 
-            # --- OR, Option B: use HuggingFaceEmbeddings for Vertex pipeline ---
-            embed_vert = HuggingFaceEmbeddings(model_name=settings.hf_embedding_model, model_kwargs={'device': device})
+            # --- OR, Option B: reuse the shared HuggingFaceEmbeddings index (see get_vector_store) ---
 
             llm_vertex = ChatVertexAI(
                 project=settings.vertex_project,
@@ -129,15 +340,7 @@ def initialize_components():
                 credentials=creds,
                 temperature=0.7, 
             )
-            vs_vertex = build_vector_store(CHUNKS_FILE, VERTEX_DB, embedding=embed_vert)
-            retr_vertex = vs_vertex.as_retriever(search_kwargs={"k": 3})
-            pipelines["vertex"]["llm"] = llm_vertex
-            pipelines["vertex"]["chain"] = RetrievalQA.from_chain_type(
-                llm=llm_vertex,
-                chain_type="stuff",
-                retriever=retr_vertex,
-                return_source_documents=True,
-            )
+            _register_pipeline("vertex", llm_vertex, retriever)
             logger.info("Vertex AI pipeline initialized successfully")
 
         except Exception as e:
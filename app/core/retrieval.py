@@ -0,0 +1,160 @@
+import time
+import logging
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from data_pipeline import SOURCES, CEFR_LEVELS, LEVEL_ANY, cefr_levels, chunk_to_document
+
+logger = logging.getLogger(__name__)
+
+# Chunk metadata "type" is the source type (grammar, vocabulary, ...), which
+# is what a request calls its *skill*.
+_SOURCE_TYPES = {cfg["type"] for cfg in SOURCES.values()}
+
+
+def request_filters(body: Dict[str, Any]) -> Dict[str, Any]:
+    """Structured retrieval filters from an exercise request body."""
+    filters: Dict[str, Any] = {}
+    levels = cefr_levels(body.get("level"))
+    if levels:
+        filters["levels"] = levels
+    skill = (body.get("skill") or "").strip().lower()
+    if skill in _SOURCE_TYPES:
+        filters["type"] = skill
+    return filters
+
+
+class PartitionedRetriever(BaseRetriever):
+    """
+    Dense retriever over the shared index that pre-filters on metadata.
+
+    With `levels` set, only the per-CEFR-level partitions are searched (so an
+    A1 request never sees C1 chunks and each search scans a fraction of the
+    corpus), plus the shared partition of level-less chunks. Results
+    from several partitions are merged by distance and de-duplicated by
+    chunk id. `type` becomes a Chroma `where` filter; when it leaves
+    nothing, the same stores are searched without it. The level filter is
+    never dropped.
+    """
+
+    store: Any
+    partitions: Dict[str, Any] = {}
+    k: int = 3
+    levels: List[str] = []
+    type: Optional[str] = None
+
+    def with_filters(self, filters: Dict[str, Any]) -> "PartitionedRetriever":
+        return self.copy(update={"levels": filters.get("levels", []), "type": filters.get("type")})
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = self.store.embeddings.embed_query(query)
+        return self.search_by_vector(vector)
+
+    def search_by_vector(self, vector: List[float], k: Optional[int] = None) -> List[Document]:
+        k = k or self.k
+        where = {"type": self.type} if self.type else None
+        # a range covering every level is just the global store
+        levels = [] if set(CEFR_LEVELS) <= set(self.levels) else self.levels
+        stores = [self.partitions[lvl] for lvl in levels if lvl in self.partitions]
+        if stores and LEVEL_ANY in self.partitions:
+            stores.append(self.partitions[LEVEL_ANY])
+        docs = self._search_stores(stores or [self.store], vector, k, where)
+        if not docs and where:
+            docs = self._search_stores(stores or [self.store], vector, k, None)
+        return docs
+
+    @staticmethod
+    def _search_stores(stores: List[Any], vector: List[float], k: int, where: Optional[Dict[str, Any]]) -> List[Document]:
+        hits = []
+        for store in stores:
+            hits.extend(store.similarity_search_by_vector_with_relevance_scores(vector, k=k, filter=where))
+        hits.sort(key=lambda h: h[1])  # Chroma scores are distances: lower is closer
+
+        docs, seen = [], set()
+        for doc, _ in hits:
+            cid = doc.metadata.get("id")
+            if cid in seen:
+                continue
+            seen.add(cid)
+            docs.append(doc)
+            if len(docs) >= k:
+                break
+        return docs
+
+
+class HybridRetriever(PartitionedRetriever):
+    """
+    BM25 + dense retrieval fused with weighted reciprocal rank fusion.
+
+    mode="hybrid" fuses both rankings (`alpha` weights the dense side),
+    "dense" / "lexical" use one side only. In hybrid mode, when the
+    running average of query-embedding latency exceeds `max_embed_ms`,
+    requests take the lexical-only fast path; every `probe_every`-th one
+    still embeds so the average can recover.
+    """
+
+    lexical: Any
+    chunks: Any
+    mode: str = "hybrid"
+    alpha: float = 0.5
+    rrf_k: int = 60
+    fetch_k: int = 10
+    max_embed_ms: Optional[float] = None
+    probe_every: int = 10
+    # shared (not copied) between with_filters() copies
+    stats: Dict[str, float] = {}
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self.mode == "dense":
+            return super()._get_relevant_documents(query, run_manager=run_manager)
+
+        lexical = self.lexical.search(query, k=self.fetch_k, levels=self.levels or None, type=self.type)
+        if not lexical and self.type:
+            lexical = self.lexical.search(query, k=self.fetch_k, levels=self.levels or None)
+        if self.mode == "lexical" or self._embedding_too_slow():
+            self.stats["lexical_only"] = self.stats.get("lexical_only", 0) + 1
+            return self._load([cid for cid, _ in lexical[: self.k]])
+
+        start = time.perf_counter()
+        vector = self.store.embeddings.embed_query(query)
+        self._record_embed_ms((time.perf_counter() - start) * 1000)
+        dense = self.search_by_vector(vector, k=self.fetch_k)
+
+        fused: Dict[str, float] = {}
+        docs_by_id: Dict[str, Document] = {}
+        for rank, doc in enumerate(dense):
+            cid = doc.metadata.get("id")
+            docs_by_id[cid] = doc
+            fused[cid] = fused.get(cid, 0.0) + self.alpha / (self.rrf_k + rank + 1)
+        for rank, (cid, _) in enumerate(lexical):
+            fused[cid] = fused.get(cid, 0.0) + (1 - self.alpha) / (self.rrf_k + rank + 1)
+
+        top = sorted(fused, key=fused.get, reverse=True)[: self.k]
+        missing = self._load([cid for cid in top if cid not in docs_by_id])
+        docs_by_id.update({d.metadata.get("id"): d for d in missing})
+        return [docs_by_id[cid] for cid in top if cid in docs_by_id]
+
+    def _load(self, ids: List[str]) -> List[Document]:
+        docs = []
+        for cid in ids:
+            chunk = self.chunks.get(cid)
+            if chunk is not None:
+                docs.append(chunk_to_document(chunk))
+        return docs
+
+    def _embedding_too_slow(self) -> bool:
+        if self.max_embed_ms is None or self.stats.get("embed_ms_ewma", 0.0) <= self.max_embed_ms:
+            return False
+        self.stats["skipped"] = self.stats.get("skipped", 0) + 1
+        return self.stats["skipped"] % self.probe_every != 0
+
+    def _record_embed_ms(self, ms: float):
+        prev = self.stats.get("embed_ms_ewma")
+        self.stats["embed_ms_ewma"] = ms if prev is None else 0.8 * prev + 0.2 * ms
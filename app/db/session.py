@@ -1,7 +1,8 @@
 import logging, time
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import text
+from sqlalchemy import text, inspect
+from sqlalchemy.schema import CreateColumn
 from app.models.exercise import Base 
 from urllib.parse import quote_plus
 from app.core.config import settings
@@ -62,17 +63,46 @@ async def get_db():
         yield None
 
 
+# True once init_db() has created / migrated the schema to match the models.
+# Persistence and the exercise pool stay off while it is False.
+schema_ready = False
+
+
+def migrate_schema(conn):
+    """
+    create_all never alters an existing table: add model columns the table
+    is missing (all of them nullable) with ALTER TABLE, then create the
+    model indexes it does not have yet.
+    """
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
+            logger.info("✔️  Added column %s.%s", table.name, column.name)
+
+        indexes = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(conn)
+                logger.info("✔️  Created index %s", index.name)
+
+
 async def init_db():
     """
     Kiểm tra kết nối và tạo tất cả tables (Base.metadata) nếu chưa tồn tại.
     Gọi hàm này trong startup event của FastAPI hoặc bất kỳ chỗ nào cần migrate.
     """
+    global schema_ready
     if engine is None:
         logger.error("DB engine unavailable, skipping init_db()")
         return
 
     try:
-        async with engine.connect() as conn:
+        async with engine.begin() as conn:
             # 1) Test connection
             await conn.execute(text("SELECT 1"))
             logger.info("✔️  Database connection successful")
@@ -80,8 +110,14 @@ async def init_db():
             # 2) Tạo bảng
             await conn.run_sync(Base.metadata.create_all)
             logger.info("✔️  All tables created")
+
+            # 3) Bổ sung cột mới cho bảng đã tồn tại
+            await conn.run_sync(migrate_schema)
+        schema_ready = True
     except Exception as e:
-        logger.error("❌  init_db failed: %s", e, exc_info=True)
+        logger.error(
+            "❌  init_db failed, persisting generations and the exercise pool are disabled: %s", e, exc_info=True
+        )
         
 
 async def health_check_db() -> dict:
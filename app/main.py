@@ -1,3 +1,4 @@
+import asyncio
 import uvicorn
 from fastapi import FastAPI
 from app.api.routers import exercise, prompt, grammar
@@ -6,12 +7,26 @@ from app.core.rag import initialize_components
 # from app.core.rag import llm, embedding, vector_store, retriever, rag_chain
 import app.core.rag as rag
 import app.db.session as db
+from app.core.backend_router import backend_router
+import app.services.exercise_service as exercise_service
+import app.services.admission as admission
+from app.services.semantic_cache import semantic_cache
+import app.services.exercise_pool as exercise_pool
+from app.services.exercise_store import persist_stats
 app = FastAPI(title="English Exercise Generator API")
 
 @app.on_event("startup")
 async def on_startup():
     initialize_components()
     await db.init_db()
+    if settings.exercise_pool_enabled:
+        app.state.pool_worker = asyncio.create_task(exercise_pool.run_pool_worker())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    worker = getattr(app.state, "pool_worker", None)
+    if worker is not None:
+        worker.cancel()
     
 @app.get("/health")
 async def health_check():
@@ -43,7 +58,19 @@ async def health_check():
         if key == "ollama" and (not llm_ok or not chain_ok):
             overall_ok = False
 
-    # 3) Configuration status
+    components["backend_router"] = backend_router.stats()
+    components["hedging"] = exercise_service.hedging_stats()
+    components["admission"] = admission.stats()
+
+    # 3) Retrieval / response caches
+    components["rag_cache"] = rag.cache_stats()
+    components["response_cache"] = exercise_service.response_cache.stats()
+    components["semantic_cache"] = semantic_cache.stats()
+    components["exercise_pool"] = exercise_pool.stats()
+    components["persistence"] = persist_stats
+    components["coalescing"] = {**exercise_service.coalescing_stats, "in_flight": len(exercise_service._inflight)}
+
+    # 4) Configuration status
     components["config"] = {
         "ollama_model": settings.ollama_model,
         "use_vertex": settings.use_vertex,
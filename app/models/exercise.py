@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, JSON, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Float, JSON, Boolean, DateTime, Text, Index
 from sqlalchemy.orm import declarative_base
 from datetime import datetime
 
@@ -6,6 +6,10 @@ Base = declarative_base()
 
 class Exercise(Base):
     __tablename__ = "exercises"
+    __table_args__ = (
+        Index("ix_exercises_skill_level_type_approved", "skill", "level", "type", "is_approved"),
+        Index("ix_exercises_pool", "skill", "level", "type", "topic", "served_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(length=100), nullable=False)
@@ -14,10 +18,12 @@ class Exercise(Base):
     type = Column(String(length=50), nullable=False)
     level = Column(String(length=50), nullable=False)
     skill = Column(String(length=50), nullable=False)
+    topic = Column(String(length=100), nullable=True)
     lesson = Column(String(length=100), nullable=True)
     generated_by = Column(String(length=100), nullable=False)
     description = Column(String(length=500), nullable=True)
     options = Column(JSON, nullable=True)
+    explanation = Column(Text, nullable=True)
     duration_seconds = Column(Float, nullable=True)
     context_length = Column(Integer, nullable=True)
     
@@ -27,4 +33,7 @@ class Exercise(Base):
     rejection_reason = Column(String(length=500), nullable=True)
     approved_at = Column(DateTime, nullable=True)
     rejected_at = Column(DateTime, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    # Pool: pre-generated exercises are unserved until handed out once
+    served_at = Column(DateTime, nullable=True, index=True)
\ No newline at end of file
@@ -0,0 +1,177 @@
+import math
+import time
+import asyncio
+import logging
+import contextlib
+from typing import Any, Dict
+
+from fastapi import HTTPException
+
+from app.core.config import settings
+from app.core.backend_router import BACKENDS, backend_router
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(prompt: str, number: int = 1) -> int:
+    """Rough prompt + completion size: ~4 characters per prompt token."""
+    return len(prompt) // 4 + int(number) * settings.est_tokens_per_exercise
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, holding at most one minute's worth. 0 = unlimited."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` is available (0 = now)."""
+        if not self.rate:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)  # an oversized request waits for a full bucket
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+
+class BackendGate:
+    """
+    Admission for one backend: request and token buckets, a cap on admitted
+    calls that have not finished yet (`pending`), and a bounded FIFO queue
+    where callers wait for both, at most settings.admission_max_queue_seconds.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests = TokenBucket(getattr(settings, f"{name}_requests_per_minute"))
+        self.tokens = TokenBucket(getattr(settings, f"{name}_tokens_per_minute"))
+        # default to the backend's concurrency: more admitted calls would only queue on its semaphore
+        self.max_pending = getattr(settings, f"{name}_max_pending") or getattr(settings, f"{name}_max_concurrency")
+        self.pending = self.queued = 0
+        self._turn = asyncio.Lock()
+        self._released = asyncio.Event()
+        self.admitted = self.rejected_rate = self.rejected_busy = 0
+        self.queue_seconds = 0.0
+
+    def _wait_time(self, tokens: int) -> float:
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def _reject(self, status: int, retry_after: float, detail: str):
+        if status == 429:
+            self.rejected_rate += 1
+        else:
+            self.rejected_busy += 1
+        raise HTTPException(
+            status_code=status,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    def _busy_retry_after(self) -> float:
+        return backend_router.backends[self.name].latency_ewma or 1.0
+
+    def check(self, tokens: int):
+        """Fail fast, without reserving anything, if a request would be rejected now."""
+        if self.queued >= settings.admission_max_queue:
+            self._reject(503, self._busy_retry_after(), f"{self.name} queue is full, try again later")
+        wait = self._wait_time(tokens)
+        if wait > settings.admission_max_queue_seconds:
+            self._reject(429, wait, f"{self.name} rate limit reached")
+
+    def immediate(self, tokens: int) -> bool:
+        """Whether a call would be admitted right now, without queueing."""
+        return (
+            not self.queued
+            and not (self.max_pending and self.pending >= self.max_pending)
+            and self._wait_time(tokens) == 0
+        )
+
+    @contextlib.asynccontextmanager
+    async def admit(self, tokens: int):
+        """Wait (bounded) for a pending slot and the buckets, then count the call as pending while it runs."""
+        self.check(tokens)
+        start = time.monotonic()
+        deadline = start + settings.admission_max_queue_seconds
+        self.queued += 1
+        try:
+            async with self._turn:  # FIFO: one caller at a time waits for a slot and the buckets
+                while True:
+                    if self.max_pending and self.pending >= self.max_pending:
+                        self._released.clear()
+                        try:
+                            await asyncio.wait_for(self._released.wait(), max(0.0, deadline - time.monotonic()))
+                        except asyncio.TimeoutError:
+                            self._reject(503, self._busy_retry_after(), f"{self.name} is saturated, try again later")
+                        continue
+                    wait = self._wait_time(tokens)
+                    if wait == 0:
+                        break
+                    if time.monotonic() + wait > deadline:
+                        self._reject(429, wait, f"{self.name} rate limit reached")
+                    await asyncio.sleep(wait)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+        finally:
+            self.queued -= 1
+
+        self.admitted += 1
+        self.queue_seconds += time.monotonic() - start
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+            self._released.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected_rate_limited": self.rejected_rate,
+            "rejected_saturated": self.rejected_busy,
+            "avg_queue_seconds": round(self.queue_seconds / self.admitted, 3) if self.admitted else 0.0,
+        }
+
+
+gates = {name: BackendGate(name) for name in BACKENDS}
+
+
+def check(backend: str | None, tokens: int):
+    if backend in gates:
+        gates[backend].check(tokens)
+
+
+def immediate(backend: str | None, tokens: int) -> bool:
+    return backend not in gates or gates[backend].immediate(tokens)
+
+
+@contextlib.asynccontextmanager
+async def admit(backend: str | None, tokens: int):
+    """
+    Admission for one LLM call on `backend`: raises HTTPException 429
+    (rate limit would need more than ADMISSION_MAX_QUEUE_SECONDS) or 503
+    (too many pending/queued calls), both with Retry-After.
+    """
+    if backend not in gates:
+        yield
+        return
+    async with gates[backend].admit(tokens):
+        yield
+
+
+def stats() -> Dict[str, Any]:
+    return {name: gate.stats() for name, gate in gates.items()}
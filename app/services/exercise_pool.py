@@ -0,0 +1,193 @@
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.config import settings
+import app.core.rag as rag
+from app.core.backend_router import backend_router
+import app.core.prompts as prompt
+from app.core.retrieval import request_filters
+import app.db.session as db_session
+from app.db.session import AsyncSessionLocal
+from app.models import Exercise
+from app.services.exercise_service import _generate_exercise
+from app.services.exercise_store import exercise_rows, exercise_to_dict, insert_rows
+
+logger = logging.getLogger(__name__)
+
+Bucket = Tuple[str, str, str, str]  # (skill, level, type, topic)
+
+# Buckets kept stocked: configured ones (None) plus up to
+# settings.exercise_pool_max_requested_buckets requested in pool mode,
+# by last request time, dropped after settings.exercise_pool_bucket_ttl.
+_buckets: Dict[Bucket, Optional[float]] = {}
+pool_stats = {"hits": 0, "misses": 0, "served": 0, "generated": 0, "refill_errors": 0}
+
+
+def bucket_of(request: Dict[str, Any]) -> Bucket:
+    return tuple(" ".join(str(request.get(f) or "").split()) for f in ("skill", "level", "type", "topic"))
+
+
+def _track_bucket(bucket: Bucket):
+    """Remember a requested bucket for refilling, within the cap."""
+    if bucket in _buckets:
+        if _buckets[bucket] is not None:
+            _buckets[bucket] = time.monotonic()
+        return
+    requested = sum(1 for seen in _buckets.values() if seen is not None)
+    if requested < settings.exercise_pool_max_requested_buckets:
+        _buckets[bucket] = time.monotonic()
+
+
+def _expire_buckets():
+    now = time.monotonic()
+    for bucket, seen in list(_buckets.items()):
+        if seen is not None and now - seen > settings.exercise_pool_bucket_ttl:
+            del _buckets[bucket]
+
+
+def _bucket_filter(bucket: Bucket):
+    skill, level, type_, topic = bucket
+    return (
+        Exercise.skill == skill,
+        Exercise.level == level,
+        Exercise.type == type_,
+        Exercise.topic == topic,
+        Exercise.served_at.is_(None),
+        Exercise.is_rejected.is_(False),
+    )
+
+
+# -------------------------
+# Serving
+# -------------------------
+async def take(db: AsyncSession, request: Dict[str, Any], number: int) -> Optional[Dict[str, Any]]:
+    """
+    Hand out `number` unserved exercises from the request's bucket, or None
+    if the bucket holds fewer (nothing is consumed then). Rows are locked
+    with SKIP LOCKED so concurrent requests never get the same exercise.
+    """
+    if not db_session.schema_ready:
+        return None
+    start = datetime.utcnow()
+    bucket = bucket_of(request)
+    _track_bucket(bucket)
+    result = await db.execute(
+        select(Exercise)
+        .where(*_bucket_filter(bucket))
+        .order_by(Exercise.id)
+        .limit(number)
+        .with_for_update(skip_locked=True)
+    )
+    rows = result.scalars().all()
+    if len(rows) < number:
+        await db.rollback()
+        pool_stats["misses"] += 1
+        return None
+
+    for row in rows:
+        row.served_at = start
+    exercises = [exercise_to_dict(row) for row in rows]
+    await db.commit()
+    pool_stats["hits"] += 1
+    pool_stats["served"] += len(rows)
+    return {
+        "exercises": exercises,
+        "duration_seconds": (datetime.utcnow() - start).total_seconds(),
+        "pooled": True,
+        "context_length": max((row.context_length or 0) for row in rows),
+        "used_model": rows[0].generated_by,
+    }
+
+
+# -------------------------
+# Refilling
+# -------------------------
+async def _generate_batch(db: AsyncSession, bucket: Bucket, number: int) -> int:
+    """Generate one batch for `bucket` and store it; returns rows stored."""
+    skill, level, type_, topic = bucket
+    body = {"skill": skill, "level": level, "type": type_, "topic": topic, "number": number}
+    rag_query = (
+        f"Generate an English learning exercise for "
+        f"skill={skill}, level={level}, topic={topic}, type={type_}"
+    )
+    try:
+        context, _ = await rag.retrieve_context(rag_query, request_filters(body))
+    except RuntimeError:
+        context = ""
+
+    tpl = await prompt.get_prompt_template(settings.exercise_pool_prompt, db)
+    prompt_text = tpl.format(**body, context=context)
+    key = backend_router.choose(settings.exercise_pool_backend)
+    if key is None:
+        logger.warning("Exercise pool: no LLM pipeline available")
+        return 0
+    try:
+        result = await _generate_exercise(
+            rag.pipelines[key]["llm"], prompt_text, number, type_, backend=key, use_cache=False,
+        )
+    finally:
+        backend_router.release(key)
+    if result.get("validation_warnings"):
+        logger.warning("Exercise pool: discarded unvalidated batch for %s", bucket)
+        return 0
+
+    meta = {
+        "skill": skill, "level": level, "type": type_, "topic": topic,
+        "generated_by": key,
+        "duration_seconds": result.get("duration_seconds", 0),
+        "context_length": len(context),
+    }
+    return await insert_rows(db, exercise_rows(result["exercises"], meta))
+
+
+async def refill_once() -> int:
+    """Top every known bucket up to settings.exercise_pool_target."""
+    _expire_buckets()
+    generated = 0
+    for bucket in list(_buckets):
+        try:
+            async with AsyncSessionLocal() as db:
+                count = await db.scalar(select(func.count(Exercise.id)).where(*_bucket_filter(bucket)))
+                missing = settings.exercise_pool_target - (count or 0)
+                while missing > 0:
+                    stored = await _generate_batch(db, bucket, min(missing, settings.exercise_pool_batch_size))
+                    if not stored:
+                        break
+                    missing -= stored
+                    generated += stored
+        except Exception as e:
+            pool_stats["refill_errors"] += 1
+            logger.error("Exercise pool refill failed for %s: %s", bucket, e, exc_info=True)
+    pool_stats["generated"] += generated
+    return generated
+
+
+async def run_pool_worker():
+    """Refill loop started on app startup when settings.exercise_pool_enabled."""
+    if not db_session.schema_ready:
+        logger.error("DB schema unavailable (see init_db), exercise pool worker not started")
+        return
+    for bucket in settings.exercise_pool_buckets:
+        _buckets[bucket_of(bucket)] = None
+    logger.info("Exercise pool worker started with %d buckets", len(_buckets))
+    while True:
+        generated = await refill_once()
+        if generated:
+            logger.info("Exercise pool: generated %d exercises", generated)
+        await asyncio.sleep(settings.exercise_pool_interval)
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        **pool_stats,
+        "enabled": settings.exercise_pool_enabled,
+        "buckets": len(_buckets),
+        "target": settings.exercise_pool_target,
+    }
@@ -1,4 +1,6 @@
-import json, re, time, string
+import json, re, time, string, copy, hashlib
+import asyncio
+import contextlib
 import logging
 from fastapi import HTTPException
 
@@ -10,15 +12,19 @@ from langchain_community.llms import Ollama
 from langchain.chains import RetrievalQA
 
 from app.core.config import settings
+from app.core.cache import TTLCache
 import app.core.rag as rag
+from app.core.backend_router import backend_router
+from app.services.semantic_cache import semantic_cache
+import app.services.admission as admission
 # from app.core.prompts import get_prompt_template
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List
 
 logger = logging.getLogger(__name__)
 
 
 def clean_llm_response(text: str) -> str:
-    """Clean and sanitize LLM response to extract pure JSON."""
+    """Strip markdown fences and leading prose; the result starts with `[` or `{`."""
     if not text:
         raise ValueError("Empty response from LLM")
     
@@ -36,14 +42,12 @@ def clean_llm_response(text: str) -> str:
     if text.endswith('```'):
         text = text[:-3].strip()
     
-    # Ensure it starts and ends with array brackets
-    if not text.startswith('['):
-        # Try to find JSON array in the response
-        match = re.search(r'\[.*\]', text, re.DOTALL)
-        if match:
-            text = match.group(0)
-        else:
-            raise ValueError("No JSON array found in response")
+    # Skip any prose before the JSON array / object
+    if not text.startswith(('[', '{')):
+        match = re.search(r'[\[{]', text)
+        if not match:
+            raise ValueError("No JSON found in response")
+        text = text[match.start():]
     
     return text
 
@@ -183,6 +187,22 @@ def validate_mcq_exercise(exercise: dict) -> bool:
     logger.info("Options validation passed: %d valid options", len(options))
     return True
 
+def exercise_errors(exercise: dict, expected_type: str = 'mcq') -> List[str]:
+    """
+    Type-specific problems with one exercise: MCQs need valid options (see
+    validate_mcq_exercise); other types, whose prompts ask for no options,
+    need a question and an answer.
+    """
+    if expected_type == 'mcq':
+        return [] if validate_mcq_exercise(exercise) else ["invalid options"]
+    errors = []
+    if not str(exercise.get("question") or "").strip():
+        errors.append("missing question")
+    if not str(exercise.get("system_answer") or "").strip():
+        errors.append("missing answer")
+    return errors
+
+
 def validate_exercises_array(exercises: List[Dict[str, Any]], expected_count: int, expected_type: str) -> bool:
     """Validate the entire exercises array."""
     if len(exercises) != expected_count:
@@ -190,13 +210,113 @@ def validate_exercises_array(exercises: List[Dict[str, Any]], expected_count: in
         return False
     
     for i, exercise in enumerate(exercises):
-        if not validate_mcq_exercise(exercise):
+        if exercise_errors(exercise, expected_type):
             logger.warning(f"Exercise {i} failed validation")
             return False
     
     return True
 
 
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+_EXERCISES_WRAPPER = re.compile(r'\{\s*"exercises"\s*:\s*\[')
+
+
+class ExerciseArrayParser:
+    """
+    Incremental parser for a (streamed) JSON array of exercise objects.
+
+    feed() takes the next piece of LLM output and returns the top-level
+    objects it closed, parsed. Prose and markdown fences before the JSON
+    are skipped. Three shapes are understood: `[{...}, ...]`,
+    `{"exercises": [{...}, ...]}` and bare `{...}` objects (the case the
+    old `parsed.get("exercises", [parsed])` covered). Nothing after the
+    closing `]` is read. Objects that do not parse are counted in
+    `malformed`.
+    """
+
+    def __init__(self):
+        self.started = False
+        self.closed = False
+        self.malformed = 0
+        self._prefix = ""
+        self._buf: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _start(self) -> str:
+        """Find where the exercise objects begin; returns the text after that point."""
+        arr, obj = self._prefix.find("["), self._prefix.find("{")
+        if obj == -1 or (arr != -1 and arr < obj):
+            if arr == -1:
+                return ""
+            self.started = True
+            return self._prefix[arr + 1:]
+
+        rest = self._prefix[obj:]
+        wrapper = _EXERCISES_WRAPPER.match(rest)
+        if wrapper:
+            self.started = True
+            return rest[wrapper.end():]
+        if '{"exercises":['.startswith(re.sub(r"\s+", "", rest)):
+            return ""  # could still become the wrapper: wait for more text
+        self.started = True  # bare object(s): parse them as if inside an array
+        return rest
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        if not self.started:
+            self._prefix += text
+            text = self._start()
+            if not self.started:
+                return []
+        objects = []
+        for ch in text:
+            if self.closed:
+                break
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth, self._buf = 1, [ch]
+                elif ch == "]":
+                    self.closed = True
+                continue
+
+            self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    obj = self._load("".join(self._buf))
+                    if obj is None:
+                        self.malformed += 1
+                    else:
+                        objects.append(obj)
+        return objects
+
+    @staticmethod
+    def _load(text: str) -> Dict[str, Any] | None:
+        # strict=False allows raw newlines/tabs inside strings; the second
+        # try drops trailing commas, the most common LLM JSON mistake
+        for candidate in (text, _TRAILING_COMMA.sub(r"\1", text)):
+            try:
+                obj = json.loads(candidate, strict=False)
+            except json.JSONDecodeError:
+                continue
+            return obj if isinstance(obj, dict) else None
+        return None
+
+
 def extract_clean_json(text: str):
     match = re.search(r"{.*}", text, re.DOTALL)
     if not match:
@@ -234,83 +354,590 @@ def extract_clean_json(text: str):
 #         "duration_seconds": time.time() - start,
 #     }
 
-async def _generate_exercise(llm, prompt: str, expected_count: int = 1, expected_type: str = 'mcq') -> Dict[str, Any]:
-    """Enhanced exercise generation with robust validation."""
+async def ainvoke_llm(llm, prompt, backend: str | None = None, number: int = 1):
+    """
+    Call the LLM through its async client. The call is admitted on
+    `backend` (see admission.admit, sized for `number` exercises) and
+    bounded by the backend's semaphore; latency and failures feed the
+    backend router.
+    """
+    semaphore = rag.semaphores.get(backend) if backend else None
+    async with admission.admit(backend, admission.estimate_tokens(str(prompt), number)):
+        async with semaphore or contextlib.nullcontext():
+            async with backend_router.track(backend):
+                return await llm.ainvoke(prompt)
+
+
+async def astream_llm(llm, prompt, backend: str | None = None, number: int = 1, stop: Callable[[], bool] | None = None):
+    """
+    Yield the LLM's output text as it streams, admitted like ainvoke_llm and
+    holding the backend's semaphore. Once `stop()` is true the model stream
+    is closed and this generator ends normally, so the call is recorded as
+    a success; closing it from outside counts as a cancellation.
+    """
+    semaphore = rag.semaphores.get(backend) if backend else None
+    async with admission.admit(backend, admission.estimate_tokens(str(prompt), number)):
+        async with semaphore or contextlib.nullcontext():
+            async with backend_router.track(backend):
+                async with contextlib.aclosing(llm.astream(prompt)) as chunks:
+                    async for chunk in chunks:
+                        yield getattr(chunk, "content", chunk)
+                        if stop is not None and stop():
+                            break
+
+
+async def stream_exercises(
+    llm,
+    prompt: str,
+    expected_count: int = 1,
+    expected_type: str = 'mcq',
+    backend: str | None = None,
+):
+    """
+    Generate exercises as a stream of events:
+      {"event": "exercise", "index": i, "exercise": {...}} as soon as an
+        object closes and passes the checks for `expected_type`,
+      {"event": "invalid", "reason": ...} for objects that fail,
+      {"event": "done", ...} or {"event": "error", "detail": ...} last.
+    Generation stops once `expected_count` valid exercises were sent.
+    """
     start = time.time()
-    
+    parser = ExerciseArrayParser()
+    sent = invalid = malformed = 0
+    first_at = None
+    try:
+        finished = lambda: sent >= expected_count or parser.closed
+        # aclosing: a disconnect releases admission, semaphore and in_flight at once, not at GC
+        async with contextlib.aclosing(astream_llm(llm, prompt, backend, expected_count, stop=finished)) as texts:
+            async for text in texts:
+                exercises = parser.feed(text)
+                for _ in range(parser.malformed - malformed):
+                    yield {"event": "invalid", "reason": "malformed JSON object"}
+                malformed = parser.malformed
+                for exercise in exercises:
+                    if exercise_errors(exercise, expected_type):
+                        invalid += 1
+                        yield {"event": "invalid", "reason": "failed validation"}
+                        continue
+                    if first_at is None:
+                        first_at = time.time() - start
+                    yield {"event": "exercise", "index": sent, "exercise": exercise}
+                    sent += 1
+                    if sent >= expected_count:
+                        break
+                # no break here: astream_llm sees finished() and ends the call cleanly
+    except HTTPException:
+        raise  # admission rejected the call (429/503)
+    except Exception as e:
+        logger.error("Streaming generation on %s failed: %s", backend, e, exc_info=True)
+        yield {"event": "error", "detail": "LLM service error"}
+        return
+
+    yield {
+        "event": "done",
+        "count": sent,
+        "expected_count": expected_count,
+        "invalid": invalid + malformed,
+        "duration_seconds": time.time() - start,
+        "first_exercise_seconds": first_at,
+    }
+
+
+def _llm_signature(llm) -> Dict[str, Any]:
+    """Model name + sampling params that change what an LLM would return."""
+    return {
+        "model": getattr(llm, "model", None) or getattr(llm, "model_name", None),
+        **{p: getattr(llm, p, None) for p in ("temperature", "max_tokens", "top_p", "num_predict")},
+    }
+
+
+def generation_cache_key(llm, prompt: str, backend: str | None, expected_count: int, expected_type: str) -> str:
+    payload = json.dumps(
+        {
+            "prompt": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+            "backend": backend,
+            "llm": _llm_signature(llm),
+            "count": expected_count,
+            "type": expected_type,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Exact-match cache of validated generations, see settings.response_cache_*.
+response_cache = TTLCache(
+    settings.response_cache_size if settings.response_cache_enabled else 0,
+    ttl=settings.response_cache_ttl,
+    name="responses",
+)
+
+
+async def _generate_exercise(
+    llm,
+    prompt: str,
+    expected_count: int = 1,
+    expected_type: str = 'mcq',
+    backend: str | None = None,
+    use_cache: bool = True,
+    request: Dict[str, Any] | None = None,
+    scope: str = "",
+    render: Callable[[int], str] | None = None,
+    hedge: bool = False,
+) -> Dict[str, Any]:
+    """
+    Generate exercises, serving identical (prompt, backend, model, params)
+    requests from the response cache. Only fully validated batches are
+    cached; `use_cache=False` bypasses both lookup and store.
+
+    When the request fields are given, near-duplicate requests (same
+    `scope`/prompt/backend and template fields, similar topic) are also
+    served from the semantic cache.
+
+    `render(n)` renders the same prompt for `n` exercises; with it, batches
+    above settings.fanout_batch_size are split into concurrent sub-batches.
+    Otherwise `hedge=True` races a second backend when the first is slow.
+    """
+    start = time.time()
+    expected_count = int(expected_count)
+    key = generation_cache_key(llm, prompt, backend, expected_count, expected_type)
+    partition = (scope, (request or {}).get("prompt_name"), expected_type, backend)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            logger.info("Response cache hit for %s", backend)
+            return {**copy.deepcopy(cached), "duration_seconds": time.time() - start, "cached": True}
+        if request is not None:
+            similar = await _semantic_cache_call("lookup", request, partition, expected_count)
+            if similar is not None:
+                logger.info("Semantic cache hit for %s (similarity %.3f)", backend, similar["semantic_similarity"])
+                return {**similar, "duration_seconds": time.time() - start, "cached": True}
+
+    if render is not None and 0 < settings.fanout_batch_size < expected_count:
+        run = lambda: _generate_fanout(llm, render, expected_count, expected_type, backend)
+    elif hedge:
+        run = lambda: _generate_hedged(llm, prompt, expected_count, expected_type, backend)
+    else:
+        run = lambda: _generate_with_retries(llm, prompt, expected_count, expected_type, backend)
+
+    # every LLM call is admitted on its own backend (ainvoke_llm); cache hits and coalesced waiters are not
+    if use_cache:
+        result, coalesced = await _single_flight(key, run)
+        if coalesced:
+            return {**result, "duration_seconds": time.time() - start, "coalesced": True}
+    else:
+        result = await run()
+    if use_cache and not result.get("validation_warnings"):
+        response_cache.set(key, copy.deepcopy(result))
+        if request is not None:
+            await _semantic_cache_call("store", request, partition, expected_count, result)
+    return result
+
+
+class _Flight:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+
+
+# Generations currently running, by generation_cache_key.
+_inflight: Dict[str, _Flight] = {}
+coalescing_stats = {"leaders": 0, "waiters": 0, "max_waiters": 0}
+
+
+async def _single_flight(key: str, factory):
+    """
+    Run `factory()` once per key at a time. Concurrent callers with the same
+    key wait for the leader and share its result (a deep copy) or its
+    exception. Returns (result, coalesced).
+    """
+    while key in _inflight:
+        flight = _inflight[key]
+        flight.waiters += 1
+        coalescing_stats["waiters"] += 1
+        try:
+            return copy.deepcopy(await asyncio.shield(flight.future)), True
+        except asyncio.CancelledError:
+            if flight.future.cancelled():
+                continue  # the leader was cancelled, not us: try to lead
+            raise
+
+    flight = _inflight[key] = _Flight()
+    coalescing_stats["leaders"] += 1
+    try:
+        result = await factory()
+    except asyncio.CancelledError:
+        flight.future.cancel()
+        raise
+    except BaseException as e:
+        flight.future.set_exception(e)
+        flight.future.exception()  # mark retrieved even if nobody waited
+        raise
+    else:
+        # waiters get a pristine copy; the caller may mutate `result`
+        flight.future.set_result(copy.deepcopy(result))
+        return result, False
+    finally:
+        del _inflight[key]
+        coalescing_stats["max_waiters"] = max(coalescing_stats["max_waiters"], flight.waiters)
+        if flight.waiters:
+            logger.info("Coalesced %d waiting requests onto one generation", flight.waiters)
+
+
+async def _semantic_cache_call(method: str, *args):
+    """The semantic cache needs the embedding model; never fail generation over it."""
+    try:
+        return await getattr(semantic_cache, method)(*args)
+    except Exception as e:
+        logger.warning("Semantic cache %s failed: %s", method, e)
+        return None
+
+
+def salvage_exercises(text: str) -> tuple[List[Dict[str, Any]], int]:
+    """
+    Every complete exercise object in `text`, even when the JSON around
+    them is malformed or cut off. Returns (objects, malformed_count).
+    """
+    try:
+        parsed = json.loads(clean_llm_response(text), strict=False)
+    except ValueError:
+        parsed = None  # malformed or truncated: fall back to the incremental parser
+    if isinstance(parsed, dict):
+        parsed = parsed.get("exercises", [parsed])
+    if isinstance(parsed, list):
+        objects = [ex for ex in parsed if isinstance(ex, dict)]
+        return objects, len(parsed) - len(objects)
+
+    parser = ExerciseArrayParser()
+    objects = parser.feed(text)
+    return objects, parser.malformed
+
+
+def _question_key(exercise: Dict[str, Any]) -> str:
+    return " ".join(str(exercise.get("question") or "").lower().split())
+
+
+def validation_report(
+    exercises: List[Dict[str, Any]], seen: set | None = None, expected_type: str = 'mcq'
+) -> List[Dict[str, Any]]:
+    """
+    Per-item validation: {"index", "valid", "errors"} for each exercise.
+    An item is invalid without a question, when it fails the checks for
+    `expected_type` (see exercise_errors) or when its question repeats one
+    in `seen` or earlier in the list. `seen` is updated with the valid
+    questions.
+    """
+    seen = set() if seen is None else seen
+    report = []
+    for idx, exercise in enumerate(exercises):
+        errors = []
+        question = _question_key(exercise)
+        if not question:
+            errors.append("missing question")
+        elif question in seen:
+            errors.append("duplicate question")
+        errors += [e for e in exercise_errors(exercise, expected_type) if e not in errors]
+        if not errors:
+            seen.add(question)
+        report.append({"index": idx, "valid": not errors, "errors": errors})
+    return report
+
+
+def followup_prompt(prompt: str, missing: int, valid: List[Dict[str, Any]], problems: List[str]) -> str:
+    """
+    The original prompt, narrowed to the `missing` exercises, with the
+    questions already accepted listed so the model does not repeat them.
+    """
+    lines = [
+        prompt,
+        "",
+        f"IMPORTANT: Generate only {missing} more exercise(s) this time, in exactly the format above. "
+        f"Respond with ONLY a JSON array of {missing} object(s).",
+    ]
+    if valid:
+        lines.append("These exercises already exist. Do not repeat or paraphrase them:")
+        lines.extend(f"- {ex.get('question')}" for ex in valid)
+    if problems:
+        lines.append("Previous output was rejected for: " + "; ".join(sorted(set(problems))) + ". Avoid these problems.")
+    return "\n".join(lines)
+
+
+async def _generate_with_retries(
+    llm,
+    prompt: str,
+    expected_count: int = 1,
+    expected_type: str = 'mcq',
+    backend: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Generate `expected_count` valid exercises. Each response is validated
+    item by item and its valid exercises are kept, even from a malformed or
+    truncated array; follow-up attempts ask only for the missing or invalid
+    items, listing the accepted ones so they are not repeated.
+    """
+    start = time.time()
+
     max_retries = 3
+    exercises: List[Dict[str, Any]] = []
+    seen: set = set()
+    problems: List[str] = []
+    attempts: List[Dict[str, Any]] = []
     for attempt in range(max_retries):
+        missing = expected_count - len(exercises)
+        attempt_prompt = prompt if attempt == 0 else followup_prompt(prompt, missing, exercises, problems)
         try:
-            # Generate response
-            raw = llm.invoke(prompt)
-            text = getattr(raw, "content", str(raw))
-            
-            logger.info(f"Attempt {attempt + 1} - Raw LLM response length: {len(text)}")
-            logger.debug(f"Raw response: {text[:500]}...")  # Log first 500 chars
-            
-            # Clean response
-            try:
-                cleaned_text = clean_llm_response(text)
-                logger.debug(f"Cleaned response: {cleaned_text[:500]}...")
-            except ValueError as e:
-                logger.warning(f"Attempt {attempt + 1} - Failed to clean response: {e}")
-                if attempt == max_retries - 1:
-                    raise HTTPException(
-                        status_code=500, 
-                        detail=f"Failed to extract valid JSON from LLM response after {max_retries} attempts"
-                    )
-                continue
-            
-            # Parse JSON
-            try:
-                parsed = json.loads(cleaned_text)
-            except (ValueError, json.JSONDecodeError) as e:
-                logger.warning(f"Attempt {attempt + 1} - JSON parse error: {e}")
-                logger.debug(f"Failed JSON text: {cleaned_text}")
-                if attempt == max_retries - 1:
-                    raise HTTPException(
-                        status_code=500, 
-                        detail=f"Invalid JSON format from LLM after {max_retries} attempts"
-                    )
-                continue
-            
-            # Ensure we have a list
-            if isinstance(parsed, dict):
-                exercises = parsed.get("exercises", [parsed])
-            elif isinstance(parsed, list):
-                exercises = parsed
-            else:
-                logger.warning(f"Attempt {attempt + 1} - Unexpected response format: {type(parsed)}")
-                if attempt == max_retries - 1:
-                    raise HTTPException(status_code=500, detail="Unexpected response format from LLM")
-                continue
-            
-            # Validate structure
-            if not validate_exercises_array(exercises, expected_count, expected_type):
-                logger.warning(f"Attempt {attempt + 1} - Validation failed")
-                if attempt == max_retries - 1:
-                    # Return partially valid data with warning
-                    logger.error("All attempts failed validation, returning partial data")
-                    return {
-                        "exercises": exercises,  # Return what we have
-                        "duration_seconds": time.time() - start,
-                        "validation_warnings": ["Some exercises may not meet quality standards"]
-                    }
-                continue
-            
-            # Success!
+            raw = await ainvoke_llm(llm, attempt_prompt, backend, missing)
+        except HTTPException as e:
+            # admission rejected the call: surface the 429/503 unless exercises are already in hand
+            if not exercises:
+                raise
+            attempts.append({"attempt": attempt + 1, "requested": missing, "error": e.detail})
+            break
+        except Exception as e:
+            logger.error(f"Attempt {attempt + 1} - Unexpected error: {e}", exc_info=True)
+            attempts.append({"attempt": attempt + 1, "requested": missing, "error": "LLM service error"})
+            if attempt == max_retries - 1 and not exercises:
+                raise HTTPException(status_code=502, detail="LLM service error after multiple attempts")
+            continue
+
+        text = getattr(raw, "content", str(raw))
+        logger.info(f"Attempt {attempt + 1} - Raw LLM response length: {len(text)}")
+        logger.debug(f"Raw response: {text[:500]}...")  # Log first 500 chars
+
+        objects, malformed = salvage_exercises(text)
+        report = validation_report(objects, seen, expected_type)
+        valid = [ex for ex, item in zip(objects, report) if item["valid"]]
+        invalid = [item for item in report if not item["valid"]]
+        problems = [e for item in invalid for e in item["errors"]] + ["malformed JSON"] * bool(malformed)
+        attempts.append({
+            "attempt": attempt + 1,
+            "requested": missing,
+            "received": len(objects),
+            "valid": len(valid),
+            "malformed": malformed,
+            "invalid": invalid,
+        })
+        if invalid or malformed or len(valid) < missing:
+            logger.warning(
+                f"Attempt {attempt + 1} - {len(valid)}/{missing} valid exercises "
+                f"({malformed} malformed, {len(invalid)} invalid)"
+            )
+        exercises.extend(valid[:missing])
+
+        if len(exercises) >= expected_count:
             logger.info(f"Successfully generated {len(exercises)} exercises on attempt {attempt + 1}")
             return {
                 "exercises": exercises,
                 "duration_seconds": time.time() - start,
-                "attempt_count": attempt + 1
+                "attempt_count": attempt + 1,
+                "validation_report": attempts,
             }
-            
+
+    if not exercises:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to extract valid exercises from LLM response after {max_retries} attempts"
+        )
+
+    # Return what we have
+    logger.error(f"Only {len(exercises)}/{expected_count} valid exercises after {max_retries} attempts")
+    return {
+        "exercises": exercises,
+        "duration_seconds": time.time() - start,
+        "attempt_count": max_retries,
+        "validation_report": attempts,
+        "validation_warnings": [f"Only {len(exercises)} of {expected_count} exercises met quality standards"]
+    }
+
+
+def _split(total: int, size: int) -> List[int]:
+    """`total` as near-equal parts of at most `size`, e.g. 15/4 -> [4, 4, 4, 3]."""
+    parts = -(-total // size)
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+def _fanout_backends(backend: str | None) -> List[str]:
+    """Only `backend` unless cross-backend fan-out is enabled; the pinned policy always stays on it."""
+    if not settings.fanout_across_backends or settings.backend_policy == "pinned" or backend is None:
+        return [backend]
+    # recovering backends get their single trial call from choose(), not from fan-out parts
+    return [backend] + [
+        k for k in backend_router.candidates(backend)
+        if k != backend and backend_router.backends[k].circuit == "closed"
+    ]
+
+
+async def _generate_fanout(
+    llm,
+    render: Callable[[int], str],
+    expected_count: int,
+    expected_type: str = 'mcq',
+    backend: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Generate a large batch as concurrent sub-batches of at most
+    settings.fanout_batch_size (at most settings.fanout_max_parallel at
+    once), on `backend` or, with settings.fanout_across_backends, spread
+    round-robin over the available backends. Results are de-duplicated by
+    question; a shortfall is requested once more from `backend` with the
+    accepted questions as context. `exercise_backends[i]` is the backend
+    that produced `exercises[i]`.
+    """
+    start = time.time()
+    sizes = _split(expected_count, settings.fanout_batch_size)
+    backends = _fanout_backends(backend)
+    limit = asyncio.Semaphore(max(settings.fanout_max_parallel, 1))
+
+    async def part(i: int, n: int):
+        key = backends[i % len(backends)]
+        part_llm = llm if key == backend else rag.pipelines[key]["llm"]
+        part_prompt = (
+            f"{render(n)}\n\nThis is part {i + 1} of {len(sizes)} of a larger worksheet. "
+            f"Make these exercises different from the other parts: vary the sub-topic and focus."
+        )
+        async with limit:
+            return key, await _generate_with_retries(part_llm, part_prompt, n, expected_type, key)
+
+    results = await asyncio.gather(*(part(i, n) for i, n in enumerate(sizes)), return_exceptions=True)
+    failures = [r for r in results if isinstance(r, BaseException)]
+    parts = [r for r in results if not isinstance(r, BaseException)]
+    if not parts:
+        raise failures[0]
+
+    seen: set = set()
+    candidates = [(ex, key) for key, r in parts for ex in r["exercises"]]
+    report = validation_report([ex for ex, _ in candidates], seen, expected_type)
+    accepted = [pair for pair, item in zip(candidates, report) if item["valid"]]
+    exercises = [ex for ex, _ in accepted]
+    duplicates = len(candidates) - len(exercises)
+    attempt_count = sum(r.get("attempt_count", 1) for _, r in parts)
+
+    missing = expected_count - len(exercises)
+    if missing > 0:
+        logger.info(f"Fan-out short by {missing} ({duplicates} duplicates, {len(failures)} failed parts)")
+        try:
+            extra = await _generate_with_retries(
+                llm, followup_prompt(render(missing), missing, exercises, []), missing, expected_type, backend
+            )
+            more = extra["exercises"]
+            report = validation_report(more, seen, expected_type)
+            accepted.extend((ex, backend) for ex, item in zip(more, report) if item["valid"])
+            attempt_count += extra.get("attempt_count", 1)
         except Exception as e:
-            logger.error(f"Attempt {attempt + 1} - Unexpected error: {e}", exc_info=True)
-            if attempt == max_retries - 1:
-                raise HTTPException(status_code=502, detail="LLM service error after multiple attempts")
-            continue
-    
-    # This should never be reached due to the raises above, but just in case
-    raise HTTPException(status_code=500, detail="Failed to generate exercises after all attempts")
\ No newline at end of file
+            logger.warning(f"Fan-out top-up failed: {e}")
+
+    accepted = accepted[:expected_count]
+    exercises = [ex for ex, _ in accepted]
+    exercise_backends = [key for _, key in accepted]
+    result = {
+        "exercises": exercises,
+        "exercise_backends": exercise_backends,
+        "duration_seconds": time.time() - start,
+        "attempt_count": attempt_count,
+        "used_models": sorted({key for key in exercise_backends if key}),
+        "fanout": {
+            "parts": sizes,
+            "backends": [key for key, _ in parts],
+            "failed_parts": len(failures),
+            "duplicates": duplicates,
+        },
+    }
+    if len(exercises) < expected_count:
+        result["validation_warnings"] = [
+            f"Only {len(exercises)} of {expected_count} exercises met quality standards"
+        ]
+    return result
+
+
+hedge_stats = {"requests": 0, "hedged": 0, "skipped": 0, "primary_wins": 0, "hedge_wins": 0}
+
+
+def hedging_stats() -> Dict[str, Any]:
+    requests, hedged = hedge_stats["requests"], hedge_stats["hedged"]
+    return {
+        **hedge_stats,
+        "hedge_rate": round(hedged / requests, 4) if requests else 0.0,
+        "hedge_win_rate": round(hedge_stats["hedge_wins"] / hedged, 4) if hedged else 0.0,
+    }
+
+
+def _hedge_delay(backend: str | None) -> float:
+    state = backend_router.backends.get(backend) if backend else None
+    p95 = state.percentile(0.95) if state is not None else None
+    if p95 is None:
+        return settings.hedge_default_delay
+    return max(p95 * settings.hedge_delay_factor, settings.hedge_min_delay)
+
+
+async def _generate_hedged(
+    llm,
+    prompt: str,
+    expected_count: int = 1,
+    expected_type: str = 'mcq',
+    backend: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Run the generation on `backend`; if it has no valid result after the
+    backend's p95 call latency (see _hedge_delay), or fails before that,
+    send the same prompt to the next healthy backend as well, provided
+    that backend admits it at once (a hedge is never queued). The first
+    result passing validate_exercises_array wins and the other request is
+    cancelled. If neither is valid, the one with more exercises is returned.
+    `hedge.backend` names the backend whose result is returned.
+    """
+    hedge_stats["requests"] += 1
+    primary = asyncio.create_task(_generate_with_retries(llm, prompt, expected_count, expected_type, backend))
+    tasks = {primary: backend}
+    await asyncio.wait({primary}, timeout=_hedge_delay(backend))
+
+    if not (primary.done() and _valid_result(primary, expected_count, expected_type)):
+        alternate = next((k for k in backend_router.candidates(backend) if k != backend), None)
+        if alternate is not None and not admission.immediate(alternate, admission.estimate_tokens(prompt, expected_count)):
+            logger.info(f"Not hedging {backend} generation: {alternate} would queue")
+            hedge_stats["skipped"] += 1
+            alternate = None
+        if alternate is not None and backend_router.backends[alternate].reserve():
+            logger.info(f"Hedging {backend} generation with {alternate}")
+            hedge_stats["hedged"] += 1
+            hedge = asyncio.create_task(_generate_with_retries(
+                rag.pipelines[alternate]["llm"], prompt, expected_count, expected_type, alternate
+            ))
+            tasks[hedge] = alternate
+
+    pending = set(tasks)
+    finished = []
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if _valid_result(task, expected_count, expected_type):
+                    hedge_stats["primary_wins" if task is primary else "hedge_wins"] += 1
+                    return {**task.result(), "hedge": {"backend": tasks[task], "hedged": len(tasks) > 1}}
+                finished.append(task)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        for key in tasks.values():
+            if key != backend:
+                backend_router.release(key)  # a hedge cancelled before its call started
+
+    results = [(t, t.result()) for t in finished if t.exception() is None]
+    if not results:
+        raise finished[0].exception()
+    task, result = max(results, key=lambda tr: len(tr[1].get("exercises", [])))
+    return {**result, "hedge": {"backend": tasks[task], "hedged": len(tasks) > 1}}
+
+
+def _valid_result(task: asyncio.Task, expected_count: int, expected_type: str) -> bool:
+    if task.cancelled() or task.exception() is not None:
+        return False
+    result = task.result()
+    return not result.get("validation_warnings") and validate_exercises_array(
+        result.get("exercises", []), expected_count, expected_type
+    )
+
@@ -0,0 +1,103 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+import app.db.session as db_session
+from app.db.session import AsyncSessionLocal
+from app.models import Exercise
+
+logger = logging.getLogger(__name__)
+
+persist_stats = {"batches": 0, "rows": 0, "failed_batches": 0, "skipped_batches": 0}
+
+
+def _truncate(value: Any, length: int) -> Optional[str]:
+    return None if value is None else str(value)[:length]
+
+
+def exercise_rows(exercises: List[Dict[str, Any]], meta: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Column values for `exercises` generated for a request. `meta` carries
+    skill/level/type/topic, generated_by, duration_seconds, context_length
+    and optionally served_at; per-exercise fields fall back to it.
+    generated_by always comes from `meta` (the model's own echo of it is
+    ignored): from meta["exercise_backends"][i] for a fan-out batch.
+    """
+    per_item = meta.get("duration_seconds", 0) / max(len(exercises), 1)
+    backends = meta.get("exercise_backends") or []
+    rows = []
+    for i, ex in enumerate(exercises):
+        rows.append({
+            "name": _truncate(ex.get("name") or meta.get("name") or "Exercise", 100),
+            "question": _truncate(ex.get("question") or "", 1000),
+            "system_answer": _truncate(ex.get("system_answer"), 1000),
+            "type": _truncate(meta.get("type") or ex.get("type"), 50),
+            "level": _truncate(meta.get("level") or ex.get("level"), 50),
+            "skill": _truncate(meta.get("skill") or ex.get("skill"), 50),
+            "topic": _truncate(meta.get("topic") or ex.get("topic"), 100),
+            "lesson": _truncate(ex.get("lesson"), 100),
+            "generated_by": _truncate((backends[i] if i < len(backends) else None) or meta.get("generated_by"), 100),
+            "description": _truncate(ex.get("description"), 500),
+            "options": ex.get("options"),
+            "explanation": ex.get("explanation"),
+            "duration_seconds": per_item,
+            "context_length": meta.get("context_length", 0),
+            "served_at": meta.get("served_at"),
+        })
+    return rows
+
+
+def exercise_to_dict(row: Exercise) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "name": row.name,
+        "question": row.question,
+        "system_answer": row.system_answer,
+        "type": row.type,
+        "level": row.level,
+        "skill": row.skill,
+        "topic": row.topic,
+        "lesson": row.lesson,
+        "generated_by": row.generated_by,
+        "description": row.description,
+        "options": row.options,
+        "explanation": row.explanation,
+    }
+
+
+async def insert_rows(db: AsyncSession, rows: List[Dict[str, Any]]) -> int:
+    """One multi-row INSERT for a whole batch; returns rows inserted."""
+    if not rows:
+        return 0
+    await db.execute(insert(Exercise), rows)
+    await db.commit()
+    return len(rows)
+
+
+async def persist_batch(result: Dict[str, Any], meta: Dict[str, Any]):
+    """
+    Store a freshly generated batch as served exercises. Runs as a response
+    background task, so it never delays the response; failures are logged.
+    Cached, pooled, coalesced and unvalidated results are not stored again.
+    """
+    if (
+        not settings.persist_generations
+        or not db_session.schema_ready
+        or result.get("cached") or result.get("pooled") or result.get("coalesced")
+        or result.get("validation_warnings")
+    ):
+        persist_stats["skipped_batches"] += 1
+        return
+    rows = exercise_rows(result.get("exercises", []), {**meta, "served_at": datetime.utcnow()})
+    try:
+        async with AsyncSessionLocal() as db:
+            await insert_rows(db, rows)
+        persist_stats["batches"] += 1
+        persist_stats["rows"] += len(rows)
+    except Exception as e:
+        persist_stats["failed_batches"] += 1
+        logger.error("Failed to persist %d generated exercises: %s", len(rows), e, exc_info=True)
@@ -0,0 +1,136 @@
+import json
+import time
+import copy
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+import app.core.rag as rag
+from data_pipeline import cefr_levels
+
+logger = logging.getLogger(__name__)
+
+
+# Request fields that never reach the prompt, or are matched elsewhere
+# (topic is embedded, number is compared against the stored batch size).
+_UNKEYED_FIELDS = {"topic", "number", "use_pool", "bypass_cache", "hedge"}
+
+
+def _fold(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return " ".join(str(value if value is not None else "").lower().split())
+
+
+def request_partition(request: Dict[str, Any]) -> Tuple:
+    """
+    Exact-match part of a request: level as CEFR, skill, type and every other
+    template variable, case/whitespace folded. Only the topic is fuzzy.
+    """
+    level = "-".join(cefr_levels(request.get("level"))) or _fold(request.get("level"))
+    return (level,) + tuple(
+        (name, _fold(value)) for name, value in sorted(request.items())
+        if name not in _UNKEYED_FIELDS and name != "level"
+    )
+
+
+def normalize_request(request: Dict[str, Any]) -> str:
+    """Canonical text embedded for a request: its folded topic."""
+    return f"topic: {_fold(request.get('topic'))}"
+
+
+class SemanticCache:
+    """
+    Serves validated exercise batches for near-duplicate requests.
+
+    Entries live in partitions that must match exactly: the caller's
+    (endpoint, prompt, exercise type, backend) plus request_partition()
+    (level, skill, type and the other template variables). Within a
+    partition the entry whose topic embedding (shared RAG embedding model,
+    see app.core.rag.get_embedding) is most similar wins if its cosine
+    similarity is >= `threshold` and it holds at least as many exercises
+    as requested.
+    """
+
+    def __init__(self, maxsize: int, threshold: float, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self._entries: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        self.hit_similarity_sum = 0.0
+        self.miss_best_similarity_sum = 0.0
+
+    async def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(await asyncio.to_thread(rag.get_embedding().embed_query, text), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _best(self, vector: np.ndarray, partition: Tuple, number: int) -> Tuple[Optional[Dict], float]:
+        now = time.monotonic()
+        with self._lock:
+            if self.ttl:
+                self._entries = [e for e in self._entries if now - e["created_at"] < self.ttl]
+            candidates = [e for e in self._entries if e["partition"] == partition and e["number"] >= number]
+        best, best_sim = None, 0.0
+        for entry in candidates:
+            sim = float(np.dot(entry["vector"], vector))
+            if sim > best_sim:
+                best, best_sim = entry, sim
+        return best, best_sim
+
+    async def lookup(self, request: Dict[str, Any], partition: Tuple, number: int) -> Optional[Dict[str, Any]]:
+        if self.maxsize <= 0:
+            return None
+        vector = await self._embed(normalize_request(request))
+        entry, sim = self._best(vector, (partition, request_partition(request)), number)
+        if entry is not None and sim >= self.threshold:
+            self.hits += 1
+            self.hit_similarity_sum += sim
+            result = copy.deepcopy(entry["result"])
+            result["exercises"] = result["exercises"][:number]
+            if "exercise_backends" in result:
+                result["exercise_backends"] = result["exercise_backends"][:number]
+            result["semantic_similarity"] = round(sim, 4)
+            return result
+        self.misses += 1
+        self.miss_best_similarity_sum += sim
+        return None
+
+    async def store(self, request: Dict[str, Any], partition: Tuple, number: int, result: Dict[str, Any]):
+        if self.maxsize <= 0:
+            return
+        vector = await self._embed(normalize_request(request))
+        with self._lock:
+            self._entries.append({
+                "vector": vector,
+                "partition": (partition, request_partition(request)),
+                "number": number,
+                "result": copy.deepcopy(result),
+                "created_at": time.monotonic(),
+            })
+            if len(self._entries) > self.maxsize:
+                self._entries = self._entries[-self.maxsize:]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "avg_hit_similarity": round(self.hit_similarity_sum / self.hits, 4) if self.hits else None,
+            "avg_miss_best_similarity": round(self.miss_best_similarity_sum / self.misses, 4) if self.misses else None,
+        }
+
+
+semantic_cache = SemanticCache(
+    settings.semantic_cache_size if settings.semantic_cache_enabled else 0,
+    threshold=settings.semantic_cache_threshold,
+    ttl=settings.semantic_cache_ttl,
+)
@@ -0,0 +1,234 @@
+import io
+import gzip
+import json
+import zlib
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# -------------------------
+# Codecs
+# -------------------------
+# Records are written in blocks; every block is one independent gzip member /
+# zstd frame (or raw bytes), so a block can be decoded on its own for random
+# access while the whole file still streams as a normal .gz / .zst.
+CODEC_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise RuntimeError("zstd codec requires the 'zstandard' package") from e
+    return zstandard
+
+
+def _compress(data: bytes, codec: str | None) -> bytes:
+    if codec == "gzip":
+        return gzip.compress(data, mtime=0)  # mtime=0 keeps output deterministic
+    if codec == "zstd":
+        return _zstd().ZstdCompressor().compress(data)
+    return data
+
+
+def _decompress(data: bytes, codec: str | None) -> bytes:
+    if codec == "gzip":
+        return gzip.decompress(data)
+    if codec == "zstd":
+        return _zstd().ZstdDecompressor().decompress(data)
+    return data
+
+
+def _open_stream(path: Path, codec: str | None):
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "zstd":
+        reader = _zstd().ZstdDecompressor().stream_reader(path.open("rb"), read_across_frames=True)
+        return io.BufferedReader(reader)
+    return path.open("rb")
+
+
+def codec_from_path(path: Path) -> str | None:
+    for codec, suffix in CODEC_SUFFIXES.items():
+        if suffix and path.name.endswith(suffix):
+            return codec
+    return None
+
+
+def store_path(base: Path, codec: str | None) -> Path:
+    """`data/chunks.jsonl` + codec suffix, e.g. `data/chunks.jsonl.gz`."""
+    return base.with_name(base.name + CODEC_SUFFIXES[codec])
+
+
+# -------------------------
+# Store
+# -------------------------
+class ChunkStore:
+    """
+    Line-delimited chunk store with an offset index for lookups by id.
+
+    `<path>` holds one JSON record per line, grouped into blocks.
+    `<path>.idx` holds one `id<TAB>block_offset<TAB>block_length<TAB>line`
+    row per record. The index is valid when its last block ends exactly at
+    the data file's size; otherwise it is rebuilt on first use.
+    """
+
+    def __init__(self, path: Path, codec: str | None = None, block_size: int = 256):
+        self.path = Path(path)
+        self.codec = codec if codec is not None else codec_from_path(self.path)
+        self.block_size = block_size
+        self.index_path = self.path.with_name(self.path.name + ".idx")
+        self._index: dict[str, tuple[int, int, int]] | None = None
+
+    # ---- writing ----
+    def append(self, chunks: Iterable[dict]) -> int:
+        """Append records at the end of the store; returns how many were written."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        index = self._load_index()
+        written = 0
+        with self.path.open("ab") as data, self.index_path.open("a", encoding="utf-8") as idx:
+            offset = data.tell()
+            block: list[dict] = []
+            for chunk in chunks:
+                block.append(chunk)
+                if len(block) >= self.block_size:
+                    offset = self._write_block(block, data, idx, offset, index)
+                    written += len(block)
+                    block = []
+            if block:
+                self._write_block(block, data, idx, offset, index)
+                written += len(block)
+        return written
+
+    def _write_block(self, block, data, idx, offset, index) -> int:
+        raw = "".join(json.dumps(c, ensure_ascii=False) + "\n" for c in block).encode("utf-8")
+        payload = _compress(raw, self.codec)
+        data.write(payload)
+        for line, chunk in enumerate(block):
+            index[chunk["id"]] = (offset, len(payload), line)
+            idx.write(f"{chunk['id']}\t{offset}\t{len(payload)}\t{line}\n")
+        return offset + len(payload)
+
+    def rewrite(self, chunks: Iterable[dict]) -> int:
+        """Atomically replace the whole store (data and index) with `chunks`."""
+        tmp = ChunkStore(self.path.with_name(self.path.name + ".tmp"), self.codec, self.block_size)
+        for p in (tmp.path, tmp.index_path):
+            p.unlink(missing_ok=True)
+        written = tmp.append(chunks)
+        if not tmp.path.exists():
+            tmp.path.touch()
+            tmp.index_path.touch()
+        tmp.path.replace(self.path)
+        tmp.index_path.replace(self.index_path)
+        self._index = None
+        return written
+
+    # ---- reading ----
+    def __iter__(self) -> Iterator[dict]:
+        """Stream every record; undecodable lines are skipped, not fatal."""
+        if not self.path.exists():
+            return
+        bad = 0
+        with _open_stream(self.path, self.codec) as stream:
+            for line in stream:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    bad += 1
+        if bad:
+            logger.warning("Skipped %d corrupt records in %s", bad, self.path)
+
+    def get(self, chunk_id: str) -> dict | None:
+        entry = self._load_index().get(chunk_id)
+        if entry is None:
+            return None
+        offset, length, line = entry
+        with self.path.open("rb") as f:
+            f.seek(offset)
+            block = _decompress(f.read(length), self.codec)
+        return json.loads(block.splitlines()[line])
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self._load_index()
+
+    def __len__(self) -> int:
+        return len(self._load_index())
+
+    # ---- index ----
+    def _load_index(self) -> dict[str, tuple[int, int, int]]:
+        if self._index is not None:
+            return self._index
+        index: dict[str, tuple[int, int, int]] = {}
+        end = 0
+        if self.index_path.exists():
+            with self.index_path.open("r", encoding="utf-8") as f:
+                for row in f:
+                    cid, offset, length, line = row.rstrip("\n").split("\t")
+                    index[cid] = (int(offset), int(length), int(line))
+                    end = max(end, int(offset) + int(length))
+        size = self.path.stat().st_size if self.path.exists() else 0
+        if end != size:
+            logger.warning("Chunk index %s is stale, rebuilding", self.index_path)
+            index = self._rebuild_index()
+        self._index = index
+        return index
+
+    def _blocks(self) -> Iterator[tuple[int, int, bytes]]:
+        """(offset, length, decoded bytes) of every block in the data file."""
+        if not self.path.exists():
+            return
+        data = self.path.read_bytes()
+        if self.codec is None:
+            # raw records need no framing: index every line as its own block
+            offset = 0
+            for line in data.splitlines(keepends=True):
+                yield offset, len(line), line
+                offset += len(line)
+            return
+        offset = 0
+        while offset < len(data):
+            if self.codec == "gzip":
+                member = zlib.decompressobj(wbits=31)
+                raw = member.decompress(data[offset:]) + member.flush()
+            else:
+                member = _zstd().ZstdDecompressor().decompressobj()
+                raw = member.decompress(data[offset:])
+            length = len(data) - offset - len(member.unused_data)
+            if length <= 0:
+                break
+            yield offset, length, raw
+            offset += length
+
+    def _rebuild_index(self) -> dict[str, tuple[int, int, int]]:
+        """Rewrite only `<path>.idx` from the data file, which is left untouched."""
+        index: dict[str, tuple[int, int, int]] = {}
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as idx:
+            for offset, length, raw in self._blocks():
+                for line, record in enumerate(raw.splitlines()):
+                    try:
+                        cid = json.loads(record)["id"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+                    index[cid] = (offset, length, line)
+                    idx.write(f"{cid}\t{offset}\t{length}\t{line}\n")
+        tmp.replace(self.index_path)
+        return index
+
+
+def migrate_json_chunks(json_file: Path, store: ChunkStore, iter_json) -> bool:
+    """
+    Convert a legacy `chunks.json` array into `store` once, when the store
+    does not exist yet. An existing store is never overwritten: it may be
+    newer than the JSON file even if its mtime is older (e.g. after a
+    checkout touches the JSON file). `iter_json` streams the array.
+    """
+    if not json_file.exists() or store.path.exists():
+        return False
+    n = store.rewrite(iter_json(json_file))
+    logger.info("Migrated %d chunks from %s to %s", n, json_file, store.path)
+    return True
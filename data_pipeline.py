@@ -1,19 +1,27 @@
 import os
 import re
-import uuid
 import json
+import math
+import time
+import heapq
+import shutil
+import hashlib
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import pdfplumber
 import docx2txt
 from pptx import Presentation
 import pandas as pd
+import chromadb
 
 from langchain.embeddings import VertexAIEmbeddings, HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
 from langchain.schema import Document
 
+from chunk_store import ChunkStore, store_path
+
 
 # -------------------------
 # Configuration
@@ -58,31 +66,51 @@ SOURCES = {
     }
 }
 
+# Chunking parameters that shape the indexed corpus. Any change here must
+# invalidate persisted vector stores, so they are recorded in the manifest.
+CHUNK_PARAMS = {
+    "parser": "grammar_mcq",
+    "merge_min_words": 3,
+    "metadata_fields": ["id", "source", "url", "type", "level", "name"],
+}
+
+# Bump when the on-disk index layout changes in an incompatible way.
+INDEX_SCHEMA_VERSION = 5
+INDEX_MANIFEST = "index_manifest.json"
+
+# Bump whenever extraction or parse_grammar_text output changes; it is part
+# of every extraction cache key, so old entries simply stop matching.
+PARSER_VERSION = 1
+EXTRACT_CACHE_DIR = DATA_DIR / ".extract_cache"
+
 
 # -------------------------
 # Extraction functions
 # -------------------------
-def extract_pdf(path: Path) -> str:
-    """Extract plain text from a PDF file."""
-    text = ""
+def iter_pdf_pages(path: Path, pages: range | None = None):
+    """
+    Yield the text of each page, opening the file once. Layout is decided
+    per page from the two cropped halves: if both carry text the page is
+    two-column and the halves are emitted left then right, otherwise the
+    non-empty half already is the whole page text.
+    """
     with pdfplumber.open(path) as pdf:
-        for page in pdf.pages:
-            text += page.extract_text() + "\n"
-    return text
-
-def extract_two_column_pdf(path: Path) -> str:
-    text = ""
-    with pdfplumber.open(path) as pdf:
-        for page in pdf.pages:
+        for page in _select_pages(pdf, pages):
             left = page.crop((0, 0, page.width/2, page.height)).extract_text() or ""
             right = page.crop((page.width/2, 0, page.width, page.height)).extract_text() or ""
-            # # Nối theo đúng thứ tự xuất bản: left dòng 1, right dòng 1, left dòng 2, ...
-            # left_lines  = left.splitlines()
-            # right_lines = right.splitlines()
-            # for l,r in zip(left_lines, right_lines):
-            #     text += l + " " + r + "\n"
-            text += left + "\n" + right + "\n"
-    return text
+            if left.strip() and right.strip():
+                yield left + "\n" + right + "\n"
+            else:
+                yield (left if left.strip() else right) + "\n"
+
+
+def extract_pdf(path: Path, pages: range | None = None) -> str:
+    """Extract plain text from a PDF file (optionally only `pages`)."""
+    return "".join(iter_pdf_pages(path, pages))
+
+
+def _select_pages(pdf, pages: range | None):
+    return pdf.pages if pages is None else pdf.pages[pages.start:pages.stop]
 
 
 def extract_docx(path: Path) -> str:
@@ -92,13 +120,13 @@ def extract_docx(path: Path) -> str:
 
 def extract_pptx(path: Path) -> str:
     """Extract concatenated text from PPTX slides."""
-    text = ""
     prs = Presentation(str(path))
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text
+    return "".join(
+        shape.text + "\n"
+        for slide in prs.slides
+        for shape in slide.shapes
+        if hasattr(shape, "text")
+    )
 
 
 # -------------------------
@@ -107,17 +135,8 @@ def extract_pptx(path: Path) -> str:
 
 
 # -------------------------
-# Helpers: detect layout & merge lines
+# Helpers: merge lines
 # -------------------------
-def detect_pdf_layout(path: Path) -> str:
-    with pdfplumber.open(path) as pdf:
-        page = pdf.pages[0]
-        left  = page.crop((0,0,page.width/2,page.height)).extract_text() or ""
-        right = page.crop((page.width/2,0,page.width,page.height)).extract_text() or ""
-        if left.strip() and right.strip():
-            return "two-column"
-        return "one-column"
-
 def merge_short_lines(raw: str, min_words: int = 3) -> str:
     lines = raw.splitlines()
     merged, buffer = [], ""
@@ -153,14 +172,25 @@ def chunk_text(txt: str, min_words=100, max_words=300, overlap=0.2) -> list[str]
         if len(piece) >= min_words:
             chunks.append(" ".join(piece))
     return chunks
-def parse_grammar_exercise(path: Path, layout: str) -> list[dict]:
-    # 1) Extract raw
-    if layout == "two-column":
-        raw = extract_two_column_pdf(path)
-    else:
-        raw = extract_pdf(path)
+def chunk_id(url: str, text: str) -> str:
+    """Deterministic id derived from the chunk's origin and content."""
+    return hashlib.sha256(f"{url}\n{text}".encode("utf-8")).hexdigest()[:32]
+
+
+def extract_grammar_text(path: Path, pages: range | None = None) -> str:
+    """Raw text of a grammar worksheet (or of a page range of it)."""
+    if path.suffix.lower() == ".docx":
+        return extract_docx(path)
+    return extract_pdf(path, pages)
+
+
+def parse_grammar_exercise(path: Path) -> list[dict]:
+    return parse_grammar_text(extract_grammar_text(path), path)
+
+
+def parse_grammar_text(raw: str, path: Path) -> list[dict]:
     # 2) Merge broken lines
-    raw = merge_short_lines(raw)
+    raw = merge_short_lines(raw, min_words=CHUNK_PARAMS["merge_min_words"])
     # 3) Split Q&A vs Answer Key
     parts = re.split(r"Answer Key:", raw, flags=re.IGNORECASE)
     if len(parts) < 2:
@@ -187,6 +217,7 @@ def parse_grammar_exercise(path: Path, layout: str) -> list[dict]:
     level_match = re.search(r"([a-z]\d-[a-z]\d)", path.name, re.I)
     level = level_match.group(1).upper() if level_match else None
 
+    url = f"file://{path.relative_to(DATA_DIR).as_posix()}"
     chunks: list[dict] = []
     for num, q, a, b, c, d in pattern.findall(qa_text):
         opts = [a.strip(), b.strip(), c.strip(), d.strip()]
@@ -202,9 +233,9 @@ def parse_grammar_exercise(path: Path, layout: str) -> list[dict]:
         ])
 
         chunks.append({
-            "id": str(uuid.uuid4()),
+            "id": chunk_id(url, text),
             "source": "grammar",
-            "url": f"file://{path.relative_to(DATA_DIR)}",
+            "url": url,
             "crawl_date": CRAWL_DATE,
             "type": "grammar",
             "name": path.stem,
@@ -220,60 +251,601 @@ def parse_grammar_exercise(path: Path, layout: str) -> list[dict]:
 # Pipeline stages
 # -------------------------
 
-def collect_and_process() -> list[dict]:
-    all_chunks: list[dict] = []
+def _extract_task(path: Path, pages: range | None) -> tuple[str | None, str | None, float]:
+    """Worker entrypoint: never raises, so one corrupt file can't kill the pool."""
+    start = time.time()
+    try:
+        return extract_grammar_text(path, pages), None, time.time() - start
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", time.time() - start
+
+
+# -------------------------
+# Extraction cache
+# -------------------------
+def _sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _extract_cache_key(path: Path) -> str:
+    """Content hash + parser version (+ path, since chunk urls/ids embed it)."""
+    rel = path.relative_to(DATA_DIR).as_posix()
+    return hashlib.sha256(
+        f"{PARSER_VERSION}|{rel}|{_sha256_file(path)}".encode("utf-8")
+    ).hexdigest()
+
+
+def _extract_cache_load(cache_dir: Path, key: str) -> dict | None:
+    entry = cache_dir / f"{key}.json"
+    if not entry.exists():
+        return None
+    try:
+        with entry.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _extract_cache_store(cache_dir: Path, key: str, chunks: list[dict], seconds: float):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = cache_dir / f"{key}.json.tmp"
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump({"parser_version": PARSER_VERSION, "extract_seconds": seconds, "chunks": chunks}, f, ensure_ascii=False)
+    tmp.replace(cache_dir / f"{key}.json")
+
+
+def _grammar_paths() -> list[Path]:
     cfg = SOURCES.get("grammar")
     if not cfg:
-        return all_chunks
+        return []
+    return sorted(p for ext in cfg["exts"] for p in cfg["path"].glob(f"*{ext}"))
+
+
+def extraction_cache_report(cache_dir: Path = EXTRACT_CACHE_DIR) -> dict:
+    """Dry run: how many files would be served from cache, without extracting."""
+    stats = {"files": 0, "hits": 0, "misses": 0, "seconds_saved": 0.0}
+    for path in _grammar_paths():
+        stats["files"] += 1
+        entry = _extract_cache_load(cache_dir, _extract_cache_key(path))
+        if entry is None:
+            stats["misses"] += 1
+        else:
+            stats["hits"] += 1
+            stats["seconds_saved"] += entry.get("extract_seconds", 0.0)
+    return stats
+
 
-    for ext in cfg["exts"]:
-        for path in cfg["path"].glob(f"*{ext}"):
-            layout = detect_pdf_layout(path)  # "one-column" hoặc "two-column"
-            all_chunks.extend(parse_grammar_exercise(path, layout))
+def _plan_extraction(path: Path, pages_per_task: int, fanout_min_bytes: int) -> list[tuple]:
+    """Split a large PDF into page-range tasks; everything else is one task."""
+    if path.suffix.lower() != ".pdf" or path.stat().st_size < fanout_min_bytes:
+        return [(path, None)]
+    with pdfplumber.open(path) as pdf:
+        n_pages = len(pdf.pages)
+    if n_pages <= pages_per_task:
+        return [(path, None)]
+    return [
+        (path, range(start, min(start + pages_per_task, n_pages)))
+        for start in range(0, n_pages, pages_per_task)
+    ]
+
+
+def collect_and_process(
+    workers: int | None = None,
+    pages_per_task: int = 20,
+    fanout_min_bytes: int = 2 << 20,
+    use_cache: bool = True,
+    cache_dir: Path = EXTRACT_CACHE_DIR,
+    stats: dict | None = None,
+) -> list[dict]:
+    """
+    Extract every grammar worksheet with a process pool (workers=1 runs
+    in-process). PDFs over `fanout_min_bytes` are split into page ranges of
+    `pages_per_task`. Output order is by sorted file path, independent of
+    completion order; a file that fails to extract or parse is reported and
+    skipped.
+
+    With `use_cache`, files whose content hash + PARSER_VERSION is already in
+    `cache_dir` are served from there without opening them; cache entries
+    not used by this run are pruned. Hit/miss counts and the extraction time
+    saved are printed and, if given, written into `stats`.
+    """
+    paths = _grammar_paths()
+    stats = stats if stats is not None else {}
+    stats.update({"files": len(paths), "hits": 0, "misses": 0, "failed": 0, "seconds_saved": 0.0})
+
+    cached: dict[Path, list[dict]] = {}
+    keys: dict[Path, str] = {}
+    plans: list[list[tuple]] = []
+    failed: dict[Path, str] = {}
+    for path in paths:
+        try:
+            if use_cache:
+                keys[path] = _extract_cache_key(path)
+                entry = _extract_cache_load(cache_dir, keys[path])
+                if entry is not None:
+                    cached[path] = entry["chunks"]
+                    stats["hits"] += 1
+                    stats["seconds_saved"] += entry.get("extract_seconds", 0.0)
+                    plans.append([])
+                    continue
+            stats["misses"] += 1
+            plans.append(_plan_extraction(path, pages_per_task, fanout_min_bytes))
+        except Exception as e:
+            failed[path] = f"{type(e).__name__}: {e}"
+            plans.append([])
+
+    tasks = [task for plan in plans for task in plan]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        results = [_extract_task(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_extract_task, *zip(*tasks)))
 
+    all_chunks: list[dict] = []
+    it = iter(results)
+    for path, plan in zip(paths, plans):
+        if path in cached:
+            all_chunks.extend(cached[path])
+            continue
+        parts = [next(it) for _ in plan]
+        errors = [err for _, err, _ in parts if err]
+        if errors:
+            failed[path] = errors[0]
+            continue
+        if plan:
+            start = time.time()
+            try:
+                chunks = parse_grammar_text("".join(text for text, _, _ in parts), path)
+            except Exception as e:
+                failed[path] = f"{type(e).__name__}: {e}"
+                continue
+            seconds = sum(sec for _, _, sec in parts) + time.time() - start
+            if use_cache:
+                _extract_cache_store(cache_dir, keys[path], chunks, seconds)
+            all_chunks.extend(chunks)
+
+    if use_cache and cache_dir.exists():
+        live = {f"{key}.json" for key in keys.values()}
+        for entry in cache_dir.glob("*.json"):
+            if entry.name not in live:
+                entry.unlink()
+
+    for path, err in failed.items():
+        print(f"Skipped {path.name}: {err}")
+    stats["failed"] = len(failed)
+    print(f"Extracted {len(all_chunks)} chunks from {len(paths) - len(failed)}/{len(paths)} files.")
+    if use_cache:
+        print(
+            f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses, "
+            f"~{stats['seconds_saved']:.1f}s saved."
+        )
     # TODO: xử lý thêm các nguồn khác (csv, pptx, txt, v.v.)
     return all_chunks
 
 def save_chunks(chunks: list[dict], path: Path):
-    """Serialize chunk list to JSON file."""
+    """Write chunks to a JSONL chunk store (or a legacy JSON array for *.json)."""
     path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(chunks, f, ensure_ascii=False, indent=2)
+    if path.suffix == ".json":
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(chunks, f, ensure_ascii=False, indent=2)
+    else:
+        ChunkStore(path).rewrite(chunks)
     print(f"Saved {len(chunks)} chunks to {path}")
 
 
-def build_vector_store(chunks_file: Path, persist_dir: Path, embedding):
-    """Load JSON chunks, create embeddings, and persist Chroma index."""
+def iter_chunks(chunks_file: Path):
+    """Stream chunk dicts from a JSONL chunk store or a legacy JSON array."""
+    if chunks_file.suffix == ".json":
+        return iter_json_chunks(chunks_file)
+    return iter(ChunkStore(chunks_file))
+
+
+def iter_json_chunks(chunks_file: Path, read_size: int = 1 << 16):
+    """
+    Lazily yield chunk dicts from a JSON array file, holding at most one
+    read block plus one partial record in memory.
+    """
+    decoder = json.JSONDecoder()
     with chunks_file.open("r", encoding="utf-8") as f:
-        chunks = json.load(f)
-    # docs = [Document(page_content=c["text"], metadata=c) for c in chunks]
-    for c in chunks:
-        docs = []
-        docs.append(Document(
-            page_content=c["text"],
-            metadata={
-                "id": c["id"],
-                "source": c["source"],
-                "url": c["url"],
-                "type": c["type"],
-                "level": c["level"],
-                "name": c["name"],
-            }
-        ))
-    
-    vectordb = Chroma.from_documents(
-        docs, embedding=embedding, persist_directory=str(persist_dir)
-    )
+        buf, pos, eof, started = "", 0, False, False
+        while True:
+            # skip separators, refilling the buffer as needed
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buf) or eof:
+                    break
+                buf, pos = f.read(read_size), 0
+                eof = not buf
+            if pos >= len(buf):
+                return
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError(f"{chunks_file} is not a JSON array")
+                started, pos = True, pos + 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = "" if eof else f.read(read_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield obj
+            pos = end
+            if pos >= read_size:
+                buf, pos = buf[pos:], 0
+
+
+def _batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# -------------------------
+# CEFR levels & per-level partitions
+# -------------------------
+CEFR_LEVELS = ["A1", "A2", "B1", "B2", "C1", "C2"]
+_LEVEL_ALIASES = {
+    "beginner": "A1",
+    "elementary": "A2",
+    "pre-intermediate": "A2",
+    "intermediate": "B1",
+    "upper-intermediate": "B2",
+    "advanced": "C1",
+    "proficiency": "C2",
+}
+
+
+def cefr_levels(level: str | None) -> list[str]:
+    """
+    Expand a level label into CEFR levels: "A1-A2" -> [A1, A2],
+    "a2-b2" -> [A2, B1, B2], "intermediate" -> [B1]. Unknown -> [].
+    """
+    if not level:
+        return []
+    label = level.strip().lower()
+    if label in _LEVEL_ALIASES:
+        return [_LEVEL_ALIASES[label]]
+    found = re.findall(r"[abc][12]", label)
+    if not found:
+        return []
+    lo, hi = CEFR_LEVELS.index(found[0].upper()), CEFR_LEVELS.index(found[-1].upper())
+    if lo > hi:
+        lo, hi = hi, lo
+    return CEFR_LEVELS[lo:hi + 1]
+
+
+# LangChain's default collection name: the global store predates partitions.
+GLOBAL_COLLECTION = "langchain"
+# Partition for chunks without a CEFR level, searched with every level filter.
+LEVEL_ANY = "ANY"
+PARTITIONS = CEFR_LEVELS + [LEVEL_ANY]
+
+
+def partition_name(level: str) -> str:
+    return f"level_{level.lower()}"
+
+
+def chunk_partitions(chunk: dict) -> list[str]:
+    """The CEFR levels a chunk covers, or [LEVEL_ANY] for level-less chunks."""
+    return cefr_levels(chunk.get("level")) or [LEVEL_ANY]
+
+
+def open_vector_store(persist_dir: Path, embedding) -> Chroma:
+    return Chroma(collection_name=GLOBAL_COLLECTION, persist_directory=str(persist_dir), embedding_function=embedding)
+
+
+def open_level_partitions(persist_dir: Path, embedding) -> dict[str, Chroma]:
+    """
+    One Chroma collection per CEFR level plus LEVEL_ANY, next to the global
+    collection. A level-less chunk is stored once, in LEVEL_ANY.
+    """
+    return {
+        level: Chroma(
+            collection_name=partition_name(level),
+            persist_directory=str(persist_dir),
+            embedding_function=embedding,
+        )
+        for level in PARTITIONS
+    }
+
+
+def _writable_collections(persist_dir: Path) -> dict[str, "chromadb.Collection"]:
+    """chromadb collections behind the global store (key None) and each partition."""
+    client = chromadb.PersistentClient(path=str(persist_dir))
+    names = {None: GLOBAL_COLLECTION, **{level: partition_name(level) for level in PARTITIONS}}
+    return {key: client.get_or_create_collection(name, embedding_function=None) for key, name in names.items()}
+
+
+def index_chunks(persist_dir: Path, embedding, chunks, batch_size: int = 256) -> int:
+    """
+    Embed and write chunks batch by batch, reporting throughput. Each batch
+    is embedded once and written, with its precomputed embeddings, to the
+    partition of every CEFR level the chunk covers (see chunk_partitions)
+    and to the global collection.
+    """
+    collections = _writable_collections(persist_dir)
+    start = time.time()
+    total = 0
+    for batch in _batched(chunks, batch_size):
+        docs = [chunk_to_document(c) for c in batch]
+        texts = [d.page_content for d in docs]
+        embeddings = embedding.embed_documents(texts)
+        rows = list(zip([c["id"] for c in batch], embeddings, [d.metadata for d in docs], texts))
+        targets = [
+            (collections[level], [row for row, c in zip(rows, batch) if level in chunk_partitions(c)])
+            for level in PARTITIONS
+        ] + [(collections[None], rows)]
+        for collection, selected in targets:
+            if selected:
+                ids, embs, metas, docs_ = map(list, zip(*selected))
+                collection.upsert(ids=ids, embeddings=embs, metadatas=metas, documents=docs_)
+        total += len(batch)
+        elapsed = time.time() - start
+        print(f"Indexed {total} chunks ({total / elapsed if elapsed else 0:.1f} chunks/sec)")
+    return total
+
+
+def build_vector_store(chunks_file: Path, persist_dir: Path, embedding, batch_size: int = 256):
+    """Stream JSON chunks, embed them in batches, and persist Chroma index."""
+    index_chunks(persist_dir, embedding, iter_chunks(chunks_file), batch_size=batch_size)
+    vectordb = open_vector_store(persist_dir, embedding)
     vectordb.persist()
     print("Vector store built & persisted.")
     return vectordb
+
+
+def chunk_to_document(c: dict) -> Document:
+    """Build the indexed Document; Chroma rejects None metadata values."""
+    metadata = {k: c.get(k) for k in CHUNK_PARAMS["metadata_fields"]}
+    return Document(
+        page_content=c["text"],
+        metadata={k: v for k, v in metadata.items() if v is not None},
+    )
+
+
+def sync_vector_store(chunks_file: Path, persist_dir: Path, embedding, batch_size: int = 256):
+    """
+    Incrementally bring the persisted store in line with `chunks_file`.
+    Chunk ids are content-derived, so a new or edited chunk shows up as an
+    unknown id (embedded + added) and a removed/edited one as a stale id
+    (deleted). Unchanged chunks are never re-embedded. Only ids are held
+    in memory; chunk bodies are streamed twice from disk. Ids are compared
+    per collection, so a chunk missing from any of its level partitions
+    (e.g. after a crash mid-batch) is indexed again.
+    """
+    vectordb = open_vector_store(persist_dir, embedding)
+    partitions = open_level_partitions(persist_dir, embedding)
+    existing = set(vectordb.get(include=[])["ids"])
+    in_partition = {level: set(store.get(include=[])["ids"]) for level, store in partitions.items()}
+    wanted = {c["id"] for c in iter_chunks(chunks_file)}
+
+    stale = sorted(existing - wanted)
+    for store, ids in [(vectordb, existing), *((partitions[lvl], in_partition[lvl]) for lvl in partitions)]:
+        for batch in _batched(sorted(ids - wanted), batch_size):
+            store.delete(ids=batch)
+
+    def _indexed(c: dict) -> bool:
+        return c["id"] in existing and all(c["id"] in in_partition[lvl] for lvl in chunk_partitions(c))
+
+    repaired = 0
+
+    def _new_chunks():
+        nonlocal repaired
+        seen = set()
+        for c in iter_chunks(chunks_file):
+            if not _indexed(c) and c["id"] not in seen:
+                seen.add(c["id"])
+                repaired += c["id"] in existing
+                yield c
+
+    added = index_chunks(persist_dir, embedding, _new_chunks(), batch_size=batch_size)
+    vectordb.persist()
+    print(
+        f"Vector store synced: {added - repaired} added, {repaired} repaired, {len(stale)} deleted, "
+        f"{len(existing) - len(stale) - repaired} unchanged."
+    )
+    return vectordb
+
+
+# -------------------------
+# Lexical (BM25) inverted index
+# -------------------------
+LEXICAL_INDEX = "lexical_index.json"
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    BM25 index over chunk text, built at ingestion time next to the vector
+    store. Holds only postings and per-doc (length, type, level); chunk
+    bodies are looked up in the chunk store by id.
+    """
+
+    def __init__(self, postings: dict, docs: dict, k1: float = 1.5, b: float = 0.75):
+        self.postings = postings          # term -> [[chunk_id, tf], ...]
+        self.docs = docs                  # chunk_id -> [length, type, level]
+        self.k1, self.b = k1, b
+        n = len(docs)
+        self.avgdl = sum(d[0] for d in docs.values()) / n if n else 0.0
+        self.idf = {
+            term: math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for term, plist in postings.items()
+        }
+
+    @classmethod
+    def from_chunks(cls, chunks) -> "InvertedIndex":
+        postings: dict[str, list] = {}
+        docs: dict[str, list] = {}
+        for c in chunks:
+            if c["id"] in docs:
+                continue
+            tokens = tokenize(c["text"])
+            docs[c["id"]] = [len(tokens), c.get("type"), c.get("level")]
+            counts: dict[str, int] = {}
+            for tok in tokens:
+                counts[tok] = counts.get(tok, 0) + 1
+            for tok, tf in counts.items():
+                postings.setdefault(tok, []).append([c["id"], tf])
+        return cls(postings, docs)
+
+    def save(self, path: Path):
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"postings": self.postings, "docs": self.docs}, f, ensure_ascii=False)
+        tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "InvertedIndex":
+        with path.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["postings"], data["docs"])
+
+    def search(
+        self, query: str, k: int = 10, levels: list[str] | None = None, type: str | None = None
+    ) -> list[tuple[str, float]]:
+        """
+        Top-k (chunk_id, bm25 score), honouring the same filters as dense
+        search: level-less chunks match any `levels`.
+        """
+        scores: dict[str, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for cid, tf in self.postings[term]:
+                length, doc_type, doc_level = self.docs[cid]
+                if type and doc_type != type:
+                    continue
+                if levels and not set(levels) & set(cefr_levels(doc_level) or CEFR_LEVELS):
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * length / (self.avgdl or 1))
+                scores[cid] = scores.get(cid, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+
+def build_inverted_index(chunks_file: Path, index_path: Path) -> InvertedIndex:
+    index = InvertedIndex.from_chunks(iter_chunks(chunks_file))
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    index.save(index_path)
+    print(f"Lexical index built: {len(index.docs)} chunks, {len(index.postings)} terms.")
+    return index
+
+
+# -------------------------
+# Index manifest
+# -------------------------
+def corpus_hash(chunks_file: Path) -> str:
+    """SHA-256 of the chunks file, read in blocks."""
+    return _sha256_file(chunks_file)
+
+
+def build_index_manifest(chunks_file: Path, embedding_model: str) -> dict:
+    """Describe everything that determines the content of a vector store."""
+    return {
+        "schema_version": INDEX_SCHEMA_VERSION,
+        "corpus_hash": corpus_hash(chunks_file),
+        "embedding_model": embedding_model,
+        "chunk_params": CHUNK_PARAMS,
+    }
+
+
+def read_index_manifest(persist_dir: Path) -> dict | None:
+    path = persist_dir / INDEX_MANIFEST
+    if not path.exists():
+        return None
+    try:
+        with path.open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def write_index_manifest(persist_dir: Path, manifest: dict):
+    persist_dir.mkdir(parents=True, exist_ok=True)
+    tmp = persist_dir / (INDEX_MANIFEST + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    tmp.replace(persist_dir / INDEX_MANIFEST)
+
+
+def load_or_build_vector_store(
+    chunks_file: Path, persist_dir: Path, embedding, embedding_model: str, batch_size: int = 256
+):
+    """
+    Open the persisted Chroma store when its manifest matches the current
+    corpus / embedding model / chunking params. A corpus-only change is
+    applied incrementally; anything else forces a full rebuild.
+    The manifest is written last, so an interrupted build is never reused.
+    """
+    manifest = build_index_manifest(chunks_file, embedding_model)
+    current = read_index_manifest(persist_dir) if persist_dir.exists() else None
+    if current == manifest:
+        print(f"Reusing vector store at {persist_dir} (manifest matches).")
+        if not (persist_dir / LEXICAL_INDEX).exists():
+            build_inverted_index(chunks_file, persist_dir / LEXICAL_INDEX)
+        return open_vector_store(persist_dir, embedding)
+
+    compatible = current is not None and all(
+        current.get(k) == manifest[k] for k in ("schema_version", "embedding_model", "chunk_params")
+    )
+    if persist_dir.exists() and not compatible:
+        shutil.rmtree(persist_dir)
+        print(f"Manifest mismatch, rebuilding vector store at {persist_dir}.")
+    vectordb = sync_vector_store(chunks_file, persist_dir, embedding=embedding, batch_size=batch_size)
+    build_inverted_index(chunks_file, persist_dir / LEXICAL_INDEX)
+    write_index_manifest(persist_dir, manifest)
+    return vectordb
  
 
 
 # -------------------------
 # Main pipeline entrypoint
 # -------------------------
-# if __name__ == "__main__":
-#     chunks = collect_and_process()
-#     save_chunks(chunks, DATA_DIR / "chunks.json")
-#     build_vector_store(DATA_DIR / "chunks.json", DATA_DIR / "chroma_db")
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extract the document bank and sync the vector store.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("EXTRACT_WORKERS", "0")) or None)
+    parser.add_argument("--no-cache", action="store_true", help="ignore and don't update the extraction cache")
+    parser.add_argument("--cache-report", action="store_true", help="only report extraction cache hits/misses")
+    args = parser.parse_args()
+
+    if args.cache_report:
+        report = extraction_cache_report()
+        print(
+            f"{report['files']} files: {report['hits']} cached, {report['misses']} to extract, "
+            f"~{report['seconds_saved']:.1f}s of extraction saved."
+        )
+        raise SystemExit(0)
+
+    # Re-extract the document bank and apply only the delta to the index.
+    model_name = os.getenv("HF_EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2")
+    persist_dir = Path("chroma_db") / re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+    chunks_file = store_path(DATA_DIR / "chunks.jsonl", os.getenv("CHUNK_CODEC") or None)
+    chunks = collect_and_process(workers=args.workers, use_cache=not args.no_cache)
+    save_chunks(chunks, chunks_file)
+    load_or_build_vector_store(
+        chunks_file, persist_dir,
+        embedding=HuggingFaceEmbeddings(model_name=model_name),
+        embedding_model=model_name,
+    )
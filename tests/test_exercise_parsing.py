@@ -0,0 +1,64 @@
+import json
+
+from app.services.exercise_service import ExerciseArrayParser, salvage_exercises, validation_report
+
+MCQ = {
+    "question": "She ___ to school every day.",
+    "options": [{"key": "A", "option": "go"}, {"key": "B", "option": "goes"}],
+    "system_answer": "B",
+}
+
+
+def stream(text, step=3):
+    parser = ExerciseArrayParser()
+    objects = []
+    for i in range(0, len(text), step):
+        objects += parser.feed(text[i:i + step])
+    return objects
+
+
+def test_array():
+    text = json.dumps([MCQ, MCQ])
+    assert salvage_exercises(text) == ([MCQ, MCQ], 0)
+    assert stream(text) == [MCQ, MCQ]
+
+
+def test_bare_object_is_one_exercise_not_its_options():
+    text = json.dumps(MCQ)
+    assert salvage_exercises(text) == ([MCQ], 0)
+    assert stream(text) == [MCQ]
+
+
+def test_bare_object_with_string_options():
+    exercise = {"question": "Pick one", "options": ["go", "goes"]}
+    assert salvage_exercises(json.dumps(exercise)) == ([exercise], 0)
+    assert stream(json.dumps(exercise)) == [exercise]
+
+
+def test_exercises_wrapper():
+    text = "```json\n" + json.dumps({"exercises": [MCQ, MCQ]}) + "\n```"
+    assert salvage_exercises(text) == ([MCQ, MCQ], 0)
+    assert stream(text) == [MCQ, MCQ]
+
+
+def test_truncated_wrapper_keeps_complete_objects():
+    text = json.dumps({"exercises": [MCQ, MCQ]})[:-20]
+    assert salvage_exercises(text) == ([MCQ], 0)
+
+
+def test_trailing_comma_and_truncated_tail():
+    text = "[" + json.dumps(MCQ)[:-1] + ',}, {"question": "cut off'
+    assert salvage_exercises(text) == ([MCQ], 0)
+
+
+def test_non_mcq_exercises_need_no_options():
+    fill_blank = [
+        {"question": "I ___ tea.", "system_answer": "drink", "type": "fill_blank"},
+        {"question": "She ___ home.", "system_answer": "", "type": "fill_blank"},
+    ]
+    exercises, malformed = salvage_exercises(json.dumps(fill_blank))
+    report = validation_report(exercises, expected_type="fill_blank")
+    assert malformed == 0
+    assert [item["valid"] for item in report] == [True, False]
+    assert report[1]["errors"] == ["missing answer"]
+    assert not validation_report(fill_blank[:1])[0]["valid"]  # as an MCQ it lacks options